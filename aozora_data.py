@@ -17,65 +17,165 @@
 #   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import collections
 import csv
+import functools
+import json
+import multiprocessing
+import os
 import re
+import sqlite3
+import zipfile
 
+import build_stats
+from build_stats import BuildStats
 
-with open('data/aozora/list_person_all_extended_utf8.csv') as f:
-    aozora_list = list(csv.reader(f))
-aozora_header = aozora_list[0]
-aozora_table = aozora_list[1:]
 
-library_card_url = aozora_header.index('図書カードURL')
-author_family_name = aozora_header.index('姓')
-author_given_name = aozora_header.index('名')
-author_role = aozora_header.index('役割フラグ')
-author_birth = aozora_header.index('生年月日')
-author_death = aozora_header.index('没年月日')
-input_by = aozora_header.index('入力者')
-proofread_by = aozora_header.index('校正者')
-text_url = aozora_header.index('テキストファイルURL')
-html_file_url = aozora_header.index('XHTML/HTMLファイルURL')
+#: The columns of the catalog we need, by the names of their headers.
+CATALOG_COLUMNS = dict(
+    library_card_url='図書カードURL',
+    author_family_name='姓',
+    author_given_name='名',
+    author_role='役割フラグ',
+    author_birth='生年月日',
+    author_death='没年月日',
+    input_by='入力者',
+    proofread_by='校正者',
+    text_url='テキストファイルURL',
+    html_file_url='XHTML/HTMLファイルURL')
+
+CatalogRow = collections.namedtuple('CatalogRow', CATALOG_COLUMNS)
+
+
+class AozoraCatalog:
+    """
+    The Aozora Bunko catalog of works and their authors, with one row for
+    each person involved in a work. It is only read on first use, and rows can
+    be looked up by the filename of the text or the URL of the HTML version
+    (raising KeyError if there is none, and the last matching row wins) or by
+    author.
+
+    With ``cache_filename``, the columns we need are kept in SQLite until the
+    CSV file changes, so that it doesn't need to be parsed every time.
+    """
+
+    def __init__(self, filename='data/aozora/list_person_all_extended_utf8.csv',
+                 cache_filename=None):
+        self.filename = filename
+        self.cache_filename = cache_filename
+
+    @functools.cached_property
+    def rows(self):
+        if not self.cache_filename:
+            return self.read_csv()
+        stat = os.stat(self.filename)
+        source = (os.path.abspath(self.filename), stat.st_size, stat.st_mtime)
+        conn = sqlite3.connect(self.cache_filename)
+        try:
+            conn.execute('CREATE TABLE IF NOT EXISTS source (filename text, size integer, mtime real)')
+            conn.execute(f'CREATE TABLE IF NOT EXISTS catalog ({", ".join(CATALOG_COLUMNS)})')
+            if list(conn.execute('SELECT * FROM source')) == [source]:
+                return [
+                    CatalogRow(*row)
+                    for row in conn.execute('SELECT * FROM catalog ORDER BY rowid')]
+            rows = self.read_csv()
+            conn.execute('DELETE FROM source')
+            conn.execute('DELETE FROM catalog')
+            conn.executemany(
+                f'INSERT INTO catalog VALUES ({", ".join("?" for _ in CATALOG_COLUMNS)})',
+                rows)
+            conn.execute('INSERT INTO source VALUES (?, ?, ?)', source)
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def read_csv(self):
+        with stats.timer('read catalog'):
+            with open(self.filename) as f:
+                reader = csv.reader(f)
+                header = next(reader)
+                columns = [header.index(name) for name in CATALOG_COLUMNS.values()]
+                return [
+                    CatalogRow(*(row[column] for column in columns))
+                    for row in reader]
+
+    @functools.cached_property
+    def by_text_filename_index(self):
+        return {row.text_url.split('/')[-1]: row for row in self.rows}
+
+    @functools.cached_property
+    def by_html_url_index(self):
+        return {
+            row.html_file_url.replace('http:', 'https:'): row
+            for row in self.rows}
+
+    @functools.cached_property
+    def by_author_index(self):
+        index = collections.defaultdict(list)
+        for row in self.rows:
+            index[row.author_family_name, row.author_given_name].append(row)
+        return index
+
+    def by_text_filename(self, filename):
+        return self.by_text_filename_index[filename]
+
+    def by_html_url(self, url):
+        """
+        Looks up a work by the URL of its HTML version, whether it uses http
+        or https.
+        """
+        return self.by_html_url_index[url.replace('http:', 'https:')]
+
+    def by_author(self, family_name, given_name):
+        return self.by_author_index.get((family_name, given_name), [])
+
+
+catalog = AozoraCatalog()
+
+
+stats = BuildStats('aozora_data')
 
 
 def modern_works(args):
     modern_files = list(
-        row[text_url] for row in aozora_table
-        if row[author_birth].startswith('19')
-        and not row[author_death]
-        and row[text_url].strip().split('.')[-1] in ('zip', 'txt')
+        row.text_url for row in catalog.rows
+        if row.author_birth.startswith('19')
+        and not row.author_death
+        and row.text_url.strip().split('.')[-1] in ('zip', 'txt')
         and (not args.aozora_only
-             or row[text_url].startswith('https://www.aozora.gr.jp/')))
+             or row.text_url.startswith('https://www.aozora.gr.jp/')))
     for url in modern_files:
         print(url)
 
 
 def librivox_audiobooks(args):
-    html_to_text = {
-        row[html_file_url].replace('http:', 'https:'): row[text_url]
-        for row in aozora_table}
     for line in args.librivox_links.readlines():
         line = line.strip()
         language, aozora_link, archive_id = line.split('\t')
         if language == 'Japanese':
             try:
-                text_link = html_to_text[aozora_link.replace('http:', 'https:')]
+                text_link = catalog.by_html_url(aozora_link).text_url
                 print(text_link, archive_id, sep='\t')
             except KeyError:
                 pass
 
 
+CJK_CHARACTERS = '⺀-⺙⺛-⻳㇀-㇣㐀-䶵一-鿕豈-舘並-龎🈐-🈒🈔-🈻🉀-🉈𠀀-𪛖𪜀-𫜴𫝀-𫠝𫠠-𬺡丽-𪘀'
+CJK_CHARACTERS += '0-9A-Za-z０-９Ａ-Ｚａ-ｚ々〆※×' # not actually CJK, but can have furigana
+RUBY_PATTERN = re.compile(f'｜?([{CJK_CHARACTERS}]+)《([^》]+)》')
+
+LEFT_BRACKETS = '「『（〈《“'
+RIGHT_BRACKETS = '」』）〉》”'
+TERMINATORS = '。？！'
+BOUNDARY_PATTERN = re.compile('([' + LEFT_BRACKETS + RIGHT_BRACKETS + TERMINATORS + '])')
+
+
 def sentences_in_paragraph(paragraph, ruby):
     paragraph = paragraph.replace('[', r'［').replace(']', r'］')
     if ruby:
-        cjk = '⺀-⺙⺛-⻳㇀-㇣㐀-䶵一-鿕豈-舘並-龎🈐-🈒🈔-🈻🉀-🉈𠀀-𪛖𪜀-𫜴𫝀-𫠝𫠠-𬺡丽-𪘀'
-        cjk += '0-9A-Za-z０-９Ａ-Ｚａ-ｚ々〆※×' # not actually CJK, but can have furigana
-        paragraph = re.sub(f'｜?([{cjk}]+)《([^》]+)》', r'[\1|\2]', paragraph)
-    left_brackets = '「『（〈《“'
-    right_brackets = '」』）〉》”'
-    terminators = '。？！'
-    boundary_pattern = '(['+left_brackets+right_brackets+terminators+'])'
-    parts = re.split(boundary_pattern, paragraph)
+        paragraph = RUBY_PATTERN.sub(r'[\1|\2]', paragraph)
+    parts = BOUNDARY_PATTERN.split(paragraph)
     i = 0
     sentence = ''
     character_count = 0
@@ -83,19 +183,19 @@ def sentences_in_paragraph(paragraph, ruby):
         if not sentence:
             character_count = sum(map(len, parts[:i]))
         if (parts[i].startswith('と') or parts[i].startswith('って'))\
-                and not sentence and i > 0 and parts[i-1] in right_brackets:
+                and not sentence and i > 0 and parts[i-1] in RIGHT_BRACKETS:
             # After quotations of sentences, there might be an awkward
             # "...と言います" or similar hanging around. Skip it.
             i += 2
             continue
         sentence += parts[i]
         if i+1 < len(parts):
-            bracket = left_brackets.find(parts[i+1])
-            if bracket >= 0 and i+3 < len(parts) and parts[i+3] == right_brackets[bracket]:
+            bracket = LEFT_BRACKETS.find(parts[i+1])
+            if bracket >= 0 and i+3 < len(parts) and parts[i+3] == RIGHT_BRACKETS[bracket]:
                 sentence += ''.join(parts[i+1:i+4])
                 i += 4
                 continue
-            if parts[i+1] in terminators:
+            if parts[i+1] in TERMINATORS:
                 sentence += parts[i+1]
                 sentence = sentence.strip()
                 if len(sentence) > 3:  # XXX how to better handle short sentences?
@@ -104,6 +204,7 @@ def sentences_in_paragraph(paragraph, ruby):
         i += 2
 
 
+@functools.lru_cache(maxsize=None)
 def JIS_X_0213_encode(men, ku, ten):
     """
     JIS X 0213 has two planes (men) and each plane consists of a 94x94 grid.
@@ -131,89 +232,263 @@ def JIS_X_0213_encode(men, ku, ten):
     return bytes((s1, s2)).decode('sjis_2004')
 
 
-def extract_sentences(args):
-    import os
-    import zipfile
-
-    filename_to_table_row = {
-        row[text_url].split('/')[-1]: row
-        for row in aozora_table}
-    filedir = 'data/aozora/files'
-    for filename in os.listdir(filedir):
-        table_row = filename_to_table_row[filename]
-        filepath = os.path.join(filedir, filename)
-        if zipfile.is_zipfile(filepath):
-            try:
-                with zipfile.ZipFile(filepath) as z:
-                    ruby = 'ruby' in filename
-                    url = table_row[library_card_url]
-                    for n in z.namelist():
-                        if n.endswith('.txt'):
+JIS_GAIJI = '※［＃[^］]*([12])-([0-9]{1,2})-([0-9]{1,2})］'
+UNICODE_GAIJI = r'※［＃[^］]*U\+([0-9a-fA-F]+)(?:[^］0-9a-fA-F][^］]*)?］'
+
+#: Gaiji given by their JIS X 0213 position or Unicode code point, and any
+#: other annotation, which is dropped. Other annotations may quote gaiji, so
+#: they only end at a ］ that doesn't close a gaiji. The lookahead keeps the
+#: regex from backtracking to the ］ of a quoted gaiji when there is no other.
+ANNOTATION_PATTERN = re.compile(
+    f'{JIS_GAIJI}|{UNICODE_GAIJI}'
+    '|［＃(?=((?:'
+    + JIS_GAIJI.replace('(', '(?:') + '|'
+    + UNICODE_GAIJI.replace('([', '(?:[') + '|'
+    + '[^］])*))\\5］')
+
+
+def replace_annotation(match):
+    men, ku, ten, code_point = match.group(1, 2, 3, 4)
+    if men:
+        return JIS_X_0213_encode(int(men), int(ku), int(ten))
+    elif code_point:
+        return chr(int(code_point, 16))
+    else:
+        return ''
+
+
+def normalize_annotations(line):
+    """
+    Replaces gaiji annotations by the characters they describe and strips all
+    other annotations, in a single pass over the line. Ruby is left alone, so
+    that it still applies to substituted gaiji.
+    """
+    if '［＃' not in line:
+        return line
+    return ANNOTATION_PATTERN.sub(replace_annotation, line)
+
+
+def sentences_from_work(filedir, filename, table_row):
+    """
+    Yields ``('aozora', url, id, license, creators, sentence)`` for every
+    sentence in the zipped work ``filename``, described by ``table_row`` of
+    the Aozora catalog.
+    """
+    filepath = os.path.join(filedir, filename)
+    if zipfile.is_zipfile(filepath):
+        stats.add('works')
+        try:
+            with zipfile.ZipFile(filepath) as z:
+                ruby = 'ruby' in filename
+                url = table_row.library_card_url
+                for n in z.namelist():
+                    if n.endswith('.txt'):
+                        with stats.timer('decode'):
                             text = z.read(n).decode('shift-jis')
-                            lines = text.split('\r\n')
-                            separators = [i for i, l in enumerate(lines)
-                                          if set(l) == {'-'}]
-
-                            empty_stretch = 0
-                            max_empty_stretch = 0
-                            max_empty_stretch_index = None
-                            for i, line in enumerate(lines):
-                                if line:
-                                    empty_stretch = 0
-                                else:
-                                    empty_stretch += 1
-                                    if empty_stretch > max_empty_stretch:
-                                        max_empty_stretch = empty_stretch
-                                        max_empty_stretch_index = i
-
-                            end = max_empty_stretch_index + 1
-                            license = None
-                            creators = [
-                                (table_row[author_role], table_row[author_family_name]+table_row[author_given_name]),
-                                ('入力者', table_row[input_by]),
-                                ('校正者', table_row[proofread_by])]
-                            for line in lines[end+1:]:
-                                # not the correct regex, but good enough:
-                                match = re.match('.*(https?://creativecommons.org/licenses/[!-~]*)', line)
-                                if match:
-                                    license = match.group(1)
-                                match = re.match('このファイルは、インターネットの図書館、青空文庫（https?://www.aozora.gr.jp/?）で作られました。入力、校正、制作にあたったのは、ボランティアの皆さんです。', line)
-                                if match:
-                                    # technically not a license
-                                    license = 'https://ja.wikipedia.org/wiki/%E3%83%91%E3%83%96%E3%83%AA%E3%83%83%E3%82%AF%E3%83%89%E3%83%A1%E3%82%A4%E3%83%B3'
-                                match = re.match('(.*者)：(.*)$', line)
-                                if match:
-                                    creators.append(match.group(1, 2))
-
-                            creators = '　'.join(
-                                role+'：'+name
-                                for role, name in creators
-                                if name)
-
-                            text_start = separators[1]+1
-                            text_lines = lines[text_start:end]
-                            for line_number, line in enumerate(text_lines):
-                                line = re.sub(
-                                    '※［＃[^］]*([12])-([0-9]{1,2})-([0-9]{1,2})］',
-                                    lambda m: JIS_X_0213_encode(*map(int,m.groups())),
-                                    line
-                                )
-                                line = re.sub(
-                                    r'※［＃[^］]*U\+([0-9a-fA-F]+)([^］0-9a-fA-F][^］]*)?］',
-                                    lambda m: chr(int(m.group(1), 16)),
-                                    line
-                                )
-                                line = re.sub('［＃[^］]*］', '', line)
-                                for (character_count, sentence) in sentences_in_paragraph(line, ruby):
-                                    print('\t'.join((
-                                        'aozora',
-                                        url,
-                                        ':'.join((filename, n, str(text_start+line_number), str(character_count))),
-                                        license,
-                                        creators,
-                                        sentence)))
-            except zipfile.BadZipFile:
-                pass
+                        lines = text.split('\r\n')
+                        separators = [i for i, l in enumerate(lines)
+                                      if set(l) == {'-'}]
+
+                        empty_stretch = 0
+                        max_empty_stretch = 0
+                        max_empty_stretch_index = None
+                        for i, line in enumerate(lines):
+                            if line:
+                                empty_stretch = 0
+                            else:
+                                empty_stretch += 1
+                                if empty_stretch > max_empty_stretch:
+                                    max_empty_stretch = empty_stretch
+                                    max_empty_stretch_index = i
+
+                        end = max_empty_stretch_index + 1
+                        license = None
+                        creators = [
+                            (table_row.author_role, table_row.author_family_name+table_row.author_given_name),
+                            ('入力者', table_row.input_by),
+                            ('校正者', table_row.proofread_by)]
+                        for line in lines[end+1:]:
+                            # not the correct regex, but good enough:
+                            match = re.match('.*(https?://creativecommons.org/licenses/[!-~]*)', line)
+                            if match:
+                                license = match.group(1)
+                            match = re.match('このファイルは、インターネットの図書館、青空文庫（https?://www.aozora.gr.jp/?）で作られました。入力、校正、制作にあたったのは、ボランティアの皆さんです。', line)
+                            if match:
+                                # technically not a license
+                                license = 'https://ja.wikipedia.org/wiki/%E3%83%91%E3%83%96%E3%83%AA%E3%83%83%E3%82%AF%E3%83%89%E3%83%A1%E3%82%A4%E3%83%B3'
+                            match = re.match('(.*者)：(.*)$', line)
+                            if match:
+                                creators.append(match.group(1, 2))
+
+                        creators = '　'.join(
+                            role+'：'+name
+                            for role, name in creators
+                            if name)
+
+                        text_start = separators[1]+1
+                        text_lines = lines[text_start:end]
+                        stats.add('lines', len(text_lines))
+                        for line_number, line in enumerate(text_lines):
+                            with stats.timer('normalize'):
+                                line = normalize_annotations(line)
+                            with stats.timer('split'):
+                                sentences = list(sentences_in_paragraph(line, ruby))
+                            stats.add('sentences', len(sentences))
+                            for (character_count, sentence) in sentences:
+                                yield (
+                                    'aozora',
+                                    url,
+                                    ':'.join((filename, n, str(text_start+line_number), str(character_count))),
+                                    license,
+                                    creators,
+                                    sentence)
+        except zipfile.BadZipFile:
+            pass
+
+
+def extract_work(task):
+    """
+    Returns the rows of ``sentences_from_work`` for a work extracted in a pool
+    process, together with the stats for it.
+    """
+    global stats
+    stats = BuildStats(stats.name, stats.interval)
+    rows = list(sentences_from_work(*task))
+    return rows, stats.as_dict()
+
+
+def extracted_works(tasks, processes=1):
+    """
+    Yields the list of rows of ``sentences_from_work`` for each task in turn.
+    With more than one process, works are extracted in a pool in parallel.
+    """
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            for rows, work_stats in pool.imap(extract_work, tasks):
+                stats.merge(work_stats)
+                yield rows
+    else:
+        for task in tasks:
+            yield list(sentences_from_work(*task))
+
+
+def extractor_version():
+    import hashlib
+
+    with open(__file__, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Sentences extracted from each work, stored by filename together with the
+    size and modification time of the file, the version of this extractor and
+    the catalog row of the work, so that only new or changed works need to be
+    extracted again.
+    """
+
+    def __init__(self, filename):
+        self.version = extractor_version()
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS extraction (
+                filename text PRIMARY KEY,
+                size integer,
+                mtime real,
+                version text,
+                catalog_row text,
+                rows text)
+            WITHOUT ROWID
+            ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.commit()
+        self.conn.close()
+
+    def manifest_entry(self, task):
+        filedir, filename, table_row = task
+        stat = os.stat(os.path.join(filedir, filename))
+        return filename, stat.st_size, stat.st_mtime, self.version, '\t'.join(table_row)
+
+    def lookup(self, task):
+        for (rows,) in self.conn.execute(
+                '''
+                SELECT rows FROM extraction
+                WHERE filename = ? AND size = ? AND mtime = ?
+                    AND version = ? AND catalog_row = ?
+                ''',
+                self.manifest_entry(task)):
+            return json.loads(rows)
+        return None
+
+    def contains(self, task):
+        return any(self.conn.execute(
+            '''
+            SELECT 1 FROM extraction
+            WHERE filename = ? AND size = ? AND mtime = ?
+                AND version = ? AND catalog_row = ?
+            ''',
+            self.manifest_entry(task)))
+
+    def extract(self, tasks, processes=1):
+        """
+        Like ``extracted_works``, but only works missing from the cache are
+        extracted. Entries for works that are gone are dropped.
+        """
+        hits = [self.contains(task) for task in tasks]
+        misses = [task for task, hit in zip(tasks, hits) if not hit]
+        stats.add('cache misses', len(misses))
+        stats.add('cache hits', len(tasks) - len(misses))
+        extracted = extracted_works(misses, processes)
+        for task, hit in zip(tasks, hits):
+            if hit:
+                with stats.timer('cache lookup'):
+                    rows = self.lookup(task)
+            else:
+                rows = next(extracted)
+                with stats.timer('cache update'):
+                    self.conn.execute(
+                        'INSERT OR REPLACE INTO extraction VALUES (?, ?, ?, ?, ?, ?)',
+                        (*self.manifest_entry(task), json.dumps(rows, ensure_ascii=False)))
+                    self.conn.commit()
+            yield rows
+        for _ in extracted:
+            pass  # let the pool finish cleanly
+        filenames = {filename for _, filename, _ in tasks}
+        self.conn.executemany(
+            'DELETE FROM extraction WHERE filename = ?',
+            [(filename,)
+             for (filename,) in self.conn.execute('SELECT filename FROM extraction').fetchall()
+             if filename not in filenames])
+
+
+def sentences_from_files(filedir='data/aozora/files', processes=1, cache_filename=None):
+    """
+    Yields the sentences of all works in ``filedir``, sorted by filename. With
+    more than one process, works are extracted in a pool in parallel, but
+    still yielded in the same order. With a cache, works that were already
+    extracted and haven't changed since are read from there.
+    """
+    tasks = [
+        (filedir, filename, catalog.by_text_filename(filename))
+        for filename in sorted(os.listdir(filedir))]
+    if cache_filename:
+        with ExtractionCache(cache_filename) as cache:
+            for rows in cache.extract(tasks, processes):
+                yield from rows
+    else:
+        for rows in extracted_works(tasks, processes):
+            yield from rows
+
+
+def extract_sentences(args):
+    for row in sentences_from_files(
+            processes=args.processes, cache_filename=args.extraction_cache):
+        print('\t'.join(row))
 
 
 def main(argv):
@@ -225,9 +500,24 @@ def main(argv):
         'extract-sentences'})
     parser.add_argument('--aozora-only', type=bool, default=True)
     parser.add_argument('--librivox-links', type=argparse.FileType('r'), default=None)
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes to extract works with')
+    parser.add_argument('--extraction-cache', type=str,
+                        default='data/aozora/extraction_cache.sqlite',
+                        help='where to keep extracted sentences between runs (empty to disable)')
+    parser.add_argument('--catalog', type=str,
+                        default='data/aozora/list_person_all_extended_utf8.csv')
+    parser.add_argument('--catalog-cache', type=str,
+                        default='data/aozora/list_person_all_extended_utf8.sqlite',
+                        help='where to keep the parsed catalog between runs (empty to disable)')
+    build_stats.add_arguments(parser)
     args = parser.parse_args(argv[1:])
 
+    stats.interval = args.progress_interval
+    global catalog
+    catalog = AozoraCatalog(args.catalog, args.catalog_cache)
     globals()[args.command[0].replace('-', '_')](args)
+    stats.report(args.stats_report)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,159 @@
+#   Alphabet Soup gives language learners easily digestible chunks for practice.
+#   Copyright 2019-2020 Yorwba
+
+#   Alphabet Soup is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU Affero General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+
+#   Alphabet Soup is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
+
+from collections import Counter, defaultdict
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+class BuildStats:
+    """
+    Counters and timers for the stages of a long-running build. A progress
+    line is printed to stderr every ``interval`` seconds while counting, and
+    ``report`` writes everything as JSON at the end.
+
+    Timers measure wall-clock time spent in a stage. Stages running in
+    different threads overlap, so timers need not add up to the total.
+    """
+
+    def __init__(self, name, interval=60.0):
+        self.name = name
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_progress = self.started
+        self.counters = Counter()
+        self.timers = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def add(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+        self.maybe_print_progress()
+
+    def maybe_print_progress(self):
+        now = time.monotonic()
+        if now - self.last_progress >= self.interval:
+            self.last_progress = now
+            self.print_progress()
+
+    def add_time(self, timer, seconds):
+        with self.lock:
+            self.timers[timer] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, timer):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(timer, time.monotonic() - start)
+
+    def timed(self, timer, iterable, counter=None, batch_size=1024):
+        """
+        Passes through the items of ``iterable``, counting them and timing how
+        long it takes to produce each one. The totals are updated every
+        ``batch_size`` items, so that the bookkeeping doesn't cost more than
+        producing small items.
+        """
+        iterator = iter(iterable)
+        seconds = 0.
+        count = 0
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    seconds += time.monotonic() - start
+                    return
+                seconds += time.monotonic() - start
+                count += 1
+                if count >= batch_size:
+                    self.add_time(timer, seconds)
+                    self.add(counter or timer, count)
+                    seconds = 0.
+                    count = 0
+                yield item
+        finally:
+            self.add_time(timer, seconds)
+            self.add(counter or timer, count)
+
+    def merge(self, other):
+        """
+        Adds the counters and timers of a report from another process.
+        """
+        with self.lock:
+            self.counters.update(other['counters'])
+            for timer, seconds in other['timers'].items():
+                self.timers[timer] += seconds
+        self.maybe_print_progress()
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self.started
+        with self.lock:
+            return dict(
+                name=self.name,
+                elapsed_seconds=elapsed,
+                counters=dict(self.counters),
+                per_second={
+                    counter: count / elapsed if elapsed else 0.
+                    for counter, count in self.counters.items()},
+                timers=dict(self.timers))
+
+    def print_progress(self):
+        stats = self.as_dict()
+        counters = ', '.join(
+            f'{counter} {count} ({stats["per_second"][counter]:.1f}/s)'
+            for counter, count in sorted(stats['counters'].items()))
+        timers = ', '.join(
+            f'{timer} {seconds:.1f}s'
+            for timer, seconds in sorted(stats['timers'].items()))
+        print(
+            f'[{self.name}] {stats["elapsed_seconds"]:.0f}s: {counters}; {timers}',
+            file=sys.stderr)
+
+    def report(self, filename=None):
+        if filename:
+            with open(filename, 'w') as f:
+                json.dump(self.as_dict(), f, indent=2, ensure_ascii=False)
+        else:
+            json.dump(self.as_dict(), sys.stderr, indent=2, ensure_ascii=False)
+            print(file=sys.stderr)
+
+
+def set_bulk_load_pragmas(cursor):
+    """
+    For SQLite databases which are written in one go at the end, so that a
+    crash means starting over anyway and there is no point in journaling.
+    """
+    cursor.execute('PRAGMA journal_mode = OFF')
+    cursor.execute('PRAGMA synchronous = OFF')
+    cursor.execute('PRAGMA cache_size = -1048576')  # 1 GiB
+
+
+def add_arguments(parser):
+    """
+    Adds the options controlling progress lines and the final report, which
+    every build script shares, to an ``argparse`` parser.
+    """
+    parser.add_argument('--progress-interval', type=float, default=60.0,
+                        help='seconds between progress lines on stderr')
+    parser.add_argument('--stats-report', type=str, default=None,
+                        help='write counters and stage timings as JSON to this file '
+                        '(default: stderr)')
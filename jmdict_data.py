@@ -17,18 +17,32 @@
 #   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import collections
 from collections import defaultdict
+import functools
 import lxml.etree as etree
 import gzip
+import itertools
+import multiprocessing
 import os
+import re
 import sqlite3
+import zlib
+
+import build_stats
+from build_stats import BuildStats
+
+
+stats = BuildStats('jmdict_data')
 
 
 def create_tables():
     c = conn.cursor()
+    # The parsed dictionary only lives as long as the connection, since all
+    # that gets looked up later is lemma_gloss.
     c.execute(
         '''
-        CREATE TABLE entry (
+        CREATE TEMP TABLE entry (
             ent_seq integer,
             variant integer,
             lemma text,
@@ -37,11 +51,7 @@ def create_tables():
         ''')
     c.execute(
         '''
-        CREATE INDEX entry_lemma_pos_index ON entry (lemma, pos)
-        ''')
-    c.execute(
-        '''
-        CREATE TABLE gloss (
+        CREATE TEMP TABLE gloss (
             ent_seq integer,
             variant integer,
             lang text,
@@ -50,205 +60,355 @@ def create_tables():
         ''')
     c.execute(
         '''
-        CREATE TABLE disambiguator_to_pos (
+        CREATE TEMP TABLE disambiguator_to_pos (
             disambiguator text,
             pos text)
         ''')
+    c.execute(
+        '''
+        CREATE TABLE lemma_gloss (
+            lemma text,
+            disambiguator text,
+            lang text,
+            gloss text,
+            PRIMARY KEY (lemma, disambiguator, lang, gloss))
+        WITHOUT ROWID
+        ''')
+
+
+def entry_rows(node):
+    """
+    Returns ``(ent_seq, variant, lemma, pos, lang, gloss)`` for each variant
+    and gloss language of the parsed ``<entry>`` element ``node``.
+    """
+    children = list(node)
+    ent_seq, = (child.text for child in children if child.tag == 'ent_seq')
+    kanji_elements = [child for child in children if child.tag == 'k_ele']
+    reading_elements = [child for child in children if child.tag == 'r_ele']
+    senses = [child for child in children if child.tag == 'sense']
+    transes = [child for child in children if child.tag == 'trans']
+
+    kanjis = [child.text
+             for k_ele in kanji_elements
+             for child in k_ele.iterchildren()
+             if child.tag == 'keb']
+    if not kanjis:
+        kanjis = [None]
+
+    kanji_readings = []
+    for r_ele in reading_elements:
+        restrictions = set()
+        for child in r_ele.iterchildren():
+            if child.tag == 're_restr':
+                restrictions.add(child.text)
+            elif child.tag == 'reb':
+                reading = child.text
+        for kanji in kanjis:
+            if not kanji:
+                kanji = reading
+            if not restrictions or kanji in restrictions:
+                kanji_readings.append((kanji, reading))
+
+    # (readings, miscellaneous) by [(kanji, pos)][lang][gloss]
+    rm_by_kplg = {}
+    parts_of_speech = frozenset()
+    miscellanea = frozenset()
+    for sense in senses:
+        kanji_restrictions = set()
+        reading_restrictions = set()
+        current_parts_of_speech = set()
+        current_miscellanea = set()
+        glosses = defaultdict(list)
+        for child in sense.iterchildren():
+            if child.tag == 'stagk':
+                kanji_restrictions.add(child.text)
+            elif child.tag == 'stagr':
+                reading_restrictions.add(child.text)
+            elif child.tag == 'pos':
+                current_parts_of_speech.add(child.text)
+            elif child.tag == 'misc':
+                current_miscellanea.add(child.text)
+            elif child.tag == 'gloss':
+                language = child.get('{http://www.w3.org/XML/1998/namespace}lang')
+                if not language:
+                    language = 'eng'
+                if child.text:  # XXX who adds a gloss without text???
+                    glosses[language].append(child.text)
+        if current_parts_of_speech:
+            parts_of_speech = frozenset(current_parts_of_speech)
+        if current_miscellanea:
+            miscellanea = frozenset(current_miscellanea)
+        for kanji, reading in kanji_readings:
+            if ((not kanji_restrictions
+                 or kanji in kanji_restrictions)
+                and
+                (not reading_restrictions
+                 or reading in reading_restrictions)):
+                if (kanji != reading and
+                        'word usually written using kana alone' in miscellanea):
+                    lemma_options = [kanji, reading]
+                else:
+                    lemma_options = [kanji]
+                for lemma in lemma_options:
+                    for pos in parts_of_speech:
+                        rm_by_lg = rm_by_kplg.setdefault((lemma, pos), {})
+                        for lang, gloss in glosses.items():
+                            rm_by_g = rm_by_lg.setdefault(lang, {})
+                            for glos in gloss:
+                                rm = rm_by_g.get(glos)
+                                if rm is None:
+                                    rm = rm_by_g[glos] = (set(), set())
+                                readings, misc = rm
+                                readings.add(reading)
+                                misc.update(miscellanea)
+
+    # Name translations in JMnedict
+    for trans in transes:
+        name_types = set()
+        glosses = defaultdict(list)
+        for child in trans.iterchildren():
+            if child.tag == 'name_type':
+                name_types.add(child.text)
+            elif child.tag == 'trans_det':
+                language = child.get('{http://www.w3.org/XML/1998/namespace}lang')
+                if not language:
+                    language = 'eng'
+                glosses[language].append(child.text)
+            elif child.tag == 'xref':
+                pass
+            else:
+                import pdb; pdb.set_trace()
+        for kanji, reading in kanji_readings:
+            for lemma in [kanji, reading]:
+                for pos in name_types:
+                    rm_by_lg = rm_by_kplg.setdefault((lemma, pos), {})
+                    for lang, gloss in glosses.items():
+                        rm_by_g = rm_by_lg.setdefault(lang, {})
+                        for glos in gloss:
+                            rm = rm_by_g.get(glos)
+                            if rm is None:
+                                rm = rm_by_g[glos] = (set(), set())
+                            readings, misc = rm
+                            readings.add(reading)
+
+    # gloss by [(kanji, pos)][lang][{reading}][{misc}]
+    g_by_kplrm = {}
+    for kp, rm_by_lg in rm_by_kplg.items():
+        g_by_lrm = g_by_kplrm[kp] = {}
+        for lang, rm_by_g in rm_by_lg.items():
+            g_by_rm = g_by_lrm[lang] = {}
+            for gloss, (readings, misc) in rm_by_g.items():
+                readings = frozenset(readings)
+                misc = frozenset(misc)
+                g_by_rm.setdefault(readings, {}).setdefault(misc, []).append(gloss)
+
+    # gloss by [(kanji, pos)][lang]
+    g_by_kpl = {
+        kp: {
+            lang:
+            '\n\n'.join(
+                '\n'.join(
+                    [', '.join(
+                        f'[{reading}]'
+                        for reading in readings)
+                     +':']
+                    + ['\n'.join(
+                        [f'\n({", ".join(misc)})' if misc else '']
+                        + gloss)
+                       for misc, gloss in g_by_m.items()])
+                for readings, g_by_m in g_by_rm.items())
+            for lang, g_by_rm in g_by_lrm.items()}
+        for kp, g_by_lrm in g_by_kplrm.items()}
+
+    return [
+        (ent_seq, variant_number, kanji, pos, lang, gloss)
+        for variant_number, ((kanji, pos), glosses) in enumerate(g_by_kpl.items())
+        for lang, gloss in glosses.items()]
 
 
 def read_dictionary(jmdict):
+    """
+    Yields ``(ent_seq, variant, lemma, pos, lang, gloss)`` for each entry of
+    JMdict or JMnedict. Entries are discarded as soon as they have been
+    processed, so memory use doesn't grow with the size of the dictionary.
+    """
     with gzip.open(jmdict) as f:
         for event, node in etree.iterparse(f, tag='entry'):
-            children = node.getchildren()
-            ent_seq, = (child.text for child in children if child.tag == 'ent_seq')
-            kanji_elements = [child for child in children if child.tag == 'k_ele']
-            reading_elements = [child for child in children if child.tag == 'r_ele']
-            senses = [child for child in children if child.tag == 'sense']
-            transes = [child for child in children if child.tag == 'trans']
-
-            kanjis = [child.text
-                     for k_ele in kanji_elements
-                     for child in k_ele.iterchildren()
-                     if child.tag == 'keb']
-            if not kanjis:
-                kanjis = [None]
-
-            kanji_readings = []
-            for r_ele in reading_elements:
-                restrictions = set()
-                for child in r_ele.iterchildren():
-                    if child.tag == 're_restr':
-                        restrictions.add(child.text)
-                    elif child.tag == 'reb':
-                        reading = child.text
-                for kanji in kanjis:
-                    if not kanji:
-                        kanji = reading
-                    if not restrictions or kanji in restrictions:
-                        kanji_readings.append((kanji, reading))
-
-            # (readings, miscellaneous) by [(kanji, pos)][lang][gloss]
-            rm_by_kplg = \
-                defaultdict(
-                    lambda: defaultdict(
-                        lambda: defaultdict(
-                            lambda: (set(), set()))))
-            parts_of_speech = frozenset()
-            miscellanea = frozenset()
-            for sense in senses:
-                kanji_restrictions = set()
-                reading_restrictions = set()
-                current_parts_of_speech = set()
-                current_miscellanea = set()
-                glosses = defaultdict(list)
-                for child in sense.iterchildren():
-                    if child.tag == 'stagk':
-                        kanji_restrictions.add(child.text)
-                    elif child.tag == 'stagr':
-                        reading_restrictions.add(child.text)
-                    elif child.tag == 'pos':
-                        current_parts_of_speech.add(child.text)
-                    elif child.tag == 'misc':
-                        current_miscellanea.add(child.text)
-                    elif child.tag == 'gloss':
-                        language = child.get('{http://www.w3.org/XML/1998/namespace}lang')
-                        if not language:
-                            language = 'eng'
-                        if child.text:  # XXX who adds a gloss without text???
-                            glosses[language].append(child.text)
-                if current_parts_of_speech:
-                    parts_of_speech = frozenset(current_parts_of_speech)
-                if current_miscellanea:
-                    miscellanea = frozenset(current_miscellanea)
-                for kanji, reading in kanji_readings:
-                    if ((not kanji_restrictions
-                         or kanji in kanji_restrictions)
-                        and
-                        (not reading_restrictions
-                         or reading in reading_restrictions)):
-                        if (kanji != reading and
-                                'word usually written using kana alone' in miscellanea):
-                            lemma_options = [kanji, reading]
-                        else:
-                            lemma_options = [kanji]
-                        for lemma in lemma_options:
-                            for pos in parts_of_speech:
-                                rm_by_lg = rm_by_kplg[(lemma, pos)]
-                                for lang, gloss in glosses.items():
-                                    rm_by_g = rm_by_lg[lang]
-                                    for glos in gloss:
-                                        readings, misc = rm_by_g[glos]
-                                        readings.add(reading)
-                                        misc.update(miscellanea)
-
-            # Name translations in JMnedict
-            for trans in transes:
-                name_types = set()
-                glosses = defaultdict(list)
-                for child in trans.iterchildren():
-                    if child.tag == 'name_type':
-                        name_types.add(child.text)
-                    elif child.tag == 'trans_det':
-                        language = child.get('{http://www.w3.org/XML/1998/namespace}lang')
-                        if not language:
-                            language = 'eng'
-                        glosses[language].append(child.text)
-                    elif child.tag == 'xref':
-                        pass
-                    else:
-                        import pdb; pdb.set_trace()
-                for kanji, reading in kanji_readings:
-                    for lemma in [kanji, reading]:
-                        for pos in name_types:
-                            rm_by_lg = rm_by_kplg[(lemma, pos)]
-                            for lang, gloss in glosses.items():
-                                rm_by_g = rm_by_lg[lang]
-                                for glos in gloss:
-                                    readings, misc = rm_by_g[glos]
-                                    readings.add(reading)
-
-            # gloss by [(kanji, pos)][lang][{reading}][{misc}]
-            g_by_kplrm = \
-                defaultdict(
-                    lambda: defaultdict(
-                        lambda: defaultdict(
-                            lambda: defaultdict(
-                                list))))
-            for kp, rm_by_lg in rm_by_kplg.items():
-                g_by_lrm = g_by_kplrm[kp]
-                for lang, rm_by_g in rm_by_lg.items():
-                    g_by_rm = g_by_lrm[lang]
-                    for gloss, (readings, misc) in rm_by_g.items():
-                        readings = frozenset(readings)
-                        misc = frozenset(misc)
-                        g_by_rm[readings][misc].append(gloss)
-
-            # gloss by [(kanji, pos)][lang]
-            g_by_kpl = {
-                kp: {
-                    lang:
-                    '\n\n'.join(
-                        '\n'.join(
-                            [', '.join(
-                                f'[{reading}]'
-                                for reading in readings)
-                             +':']
-                            + ['\n'.join(
-                                [f'\n({", ".join(misc)})' if misc else '']
-                                + gloss)
-                               for misc, gloss in g_by_m.items()])
-                        for readings, g_by_m in g_by_rm.items())
-                    for lang, g_by_rm in g_by_lrm.items()}
-                for kp, g_by_lrm in g_by_kplrm.items()}
-
-            for variant_number, ((kanji, pos), glosses) in enumerate(g_by_kpl.items()):
-                for lang, gloss in glosses.items():
-                    yield ent_seq, variant_number, kanji, pos, lang, gloss
-
-
-def associate_disambiguator_and_pos(args):
+            stats.add('entries')
+            rows = entry_rows(node)
+
+            # Free the entry and everything parsed before it.
+            node.clear()
+            while node.getprevious() is not None:
+                del node.getparent()[0]
+
+            yield from rows
+
+
+ROOT_START_TAG_PATTERN = re.compile(rb'<(\w+)>')
+ENTRY_END_TAG = b'</entry>'
+
+
+def read_entry_chunks(jmdict, entries_per_chunk=1000, block_size=1 << 20):
+    """
+    Splits the uncompressed XML of JMdict or JMnedict into standalone
+    documents of ``entries_per_chunk`` entries each, without parsing it. Every
+    document repeats the prologue up to the root start tag, so the entities
+    declared in the DTD can be resolved.
+    """
+    with gzip.open(jmdict) as f:
+        data = b''
+        while True:
+            block = f.read(block_size)
+            data += block
+            doctype_end = data.find(b']>')
+            if doctype_end >= 0:
+                root = ROOT_START_TAG_PATTERN.search(data, doctype_end)
+                if root:
+                    break
+            if not block:
+                raise ValueError(f'{jmdict} has no root element after its DTD')
+        prologue = data[:root.end()]
+        epilogue = b'</' + root.group(1) + b'>'
+        data = data[root.end():]
+
+        search_start = 0
+        entries_end = 0
+        entries = 0
+        while True:
+            chunk_end = 0
+            while True:
+                entry_end = data.find(ENTRY_END_TAG, search_start)
+                if entry_end < 0:
+                    # Keep looking where an end tag split across blocks could start.
+                    search_start = max(entries_end, len(data) - len(ENTRY_END_TAG) + 1)
+                    break
+                search_start = entries_end = entry_end + len(ENTRY_END_TAG)
+                entries += 1
+                if entries == entries_per_chunk:
+                    yield entries, prologue + data[chunk_end:entries_end] + epilogue
+                    chunk_end = entries_end
+                    entries = 0
+            data = data[chunk_end:]
+            search_start -= chunk_end
+            entries_end -= chunk_end
+            block = f.read(block_size)
+            if not block:
+                break
+            data += block
+        if entries:
+            yield entries, prologue + data[:entries_end] + epilogue
+
+
+def parse_entry_chunk(document):
+    root = etree.fromstring(document)
+    rows = []
+    for node in root.iterchildren('entry'):
+        rows.extend(entry_rows(node))
+    return rows
+
+
+def read_dictionary_in_parallel(jmdict, processes):
+    """
+    Like ``read_dictionary``, but parses and formats chunks of entries in a
+    pool of ``processes`` worker processes. Rows are yielded in the same
+    order, with at most two chunks per process in flight.
+    """
+    with multiprocessing.Pool(processes) as pool:
+        pending = collections.deque()
+        for entries, document in read_entry_chunks(jmdict):
+            pending.append((entries, pool.apply_async(parse_entry_chunk, (document,))))
+            while len(pending) > 2 * processes:
+                entries, rows = pending.popleft()
+                yield from rows.get()
+                stats.add('entries', entries)
+        while pending:
+            entries, rows = pending.popleft()
+            yield from rows.get()
+            stats.add('entries', entries)
+
+
+def insert_rows(c, rows, batch_size=10000):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        with stats.timer('insert'):
+            c.executemany(
+                '''
+                INSERT OR IGNORE INTO entry (ent_seq, variant, lemma, pos)
+                VALUES (?, ?, ?, ?)
+                ''',
+                [(ent_seq, variant, kanji, pos)
+                 for ent_seq, variant, kanji, pos, lang, gloss in batch])
+            c.executemany(
+                '''
+                INSERT OR IGNORE INTO gloss (ent_seq, variant, lang, gloss)
+                VALUES (?, ?, ?, ?)
+                ''',
+                [(ent_seq, variant, lang, gloss)
+                 for ent_seq, variant, kanji, pos, lang, gloss in batch])
+
+
+def associate_disambiguator_and_pos():
+    """
+    Maps the disambiguators of lemmas in the sentence database to parts of
+    speech. A disambiguator is matched once it maps to the part of speech of
+    an entry for its lemma. Each round groups lemmas by their unmatched
+    disambiguators and the parts of speech of their entries (counted with
+    multiplicity) and maps the disambiguators of groups with a single part of
+    speech, or else the intersection of the parts of speech over all groups,
+    or else all of them. The rounds run in memory until everything is
+    matched, then the mapping is inserted at once.
+    """
     c = conn.cursor()
-    c.execute(f'ATTACH DATABASE ? as sentences', (args.sentence_database,))
+
+    with stats.timer('associate load'):
+        pos_by_lemma = defaultdict(list)
+        for lemma, pos in c.execute('SELECT lemma, pos FROM entry'):
+            pos_by_lemma[lemma].append(pos)
+        pos_key_by_lemma = {
+            lemma: tuple(sorted(pos))
+            for lemma, pos in pos_by_lemma.items()}
+        pos_set_by_lemma = {
+            lemma: frozenset(pos)
+            for lemma, pos in pos_by_lemma.items()}
+
+        pos_by_disambiguator = defaultdict(set)
+        for disambiguator, pos in c.execute(
+                'SELECT disambiguator, pos FROM disambiguator_to_pos'):
+            pos_by_disambiguator[disambiguator].add(pos)
+
+        unmatched = defaultdict(set)
+        for lemma, disambiguator in c.execute(
+                'SELECT text, disambiguator FROM sentences.lemma'):
+            if (lemma in pos_set_by_lemma
+                    and disambiguator is not None
+                    and not pos_by_disambiguator[disambiguator] & pos_set_by_lemma[lemma]):
+                unmatched[lemma].add(disambiguator)
+        lemmas_by_disambiguator = defaultdict(set)
+        for lemma, disambiguators in unmatched.items():
+            for disambiguator in disambiguators:
+                lemmas_by_disambiguator[disambiguator].add(lemma)
+
+    mapping = []
     while True:
+        stats.add('association rounds')
+        frequencies = collections.Counter(
+            (tuple(sorted(disambiguators)), pos_key_by_lemma[lemma])
+            for lemma, disambiguators in unmatched.items())
         disambiguator_pos_mappings = [
-            (set(disambiguators.split('\t')), set(pos.split('\t')), frequency)
-            for disambiguators, pos, frequency
-            in c.execute(
-            '''
-            WITH
-                unmatched_disambiguators AS (
-                    SELECT
-                        sentences.lemma.text as lemma,
-                        group_concat(disambiguator, "\t") as disambiguators
-                    FROM sentences.lemma
-                    WHERE disambiguator NOT IN (
-                        SELECT disambiguator
-                        FROM disambiguator_to_pos NATURAL JOIN entry
-                        WHERE entry.lemma = sentences.lemma.text)
-                    GROUP BY sentences.lemma.text),
-                possible_pos AS (
-                    SELECT
-                        lemma,
-                        group_concat(pos, "\t") as pos
-                    FROM entry
-                    GROUP BY lemma)
-            SELECT disambiguators, pos, count(*) as frequency
-            FROM unmatched_disambiguators NATURAL JOIN possible_pos
-            GROUP BY disambiguators, pos
-            ORDER BY frequency
-            ''')]
+            (disambiguators, set(pos), frequency)
+            for (disambiguators, pos), frequency
+            in sorted(frequencies.items(), key=lambda item: item[1])]
         easy_cases = [
             (disambiguator, next(iter(pos)))
             for disambiguators, pos, frequency
             in disambiguator_pos_mappings
             if len(pos) == 1
             for disambiguator in disambiguators]
-        c.executemany(
-            '''
-            INSERT INTO disambiguator_to_pos (disambiguator, pos)
-            VALUES (?, ?)
-            ''',
-            easy_cases)
+        new_cases = easy_cases
         if not easy_cases:
             intersections = {}
             for disambiguators, pos, frequency in disambiguator_pos_mappings:
@@ -262,12 +422,7 @@ def associate_disambiguator_and_pos(args):
                 (disambiguator, po)
                 for disambiguator, pos in intersections.items()
                 for po in pos]
-            c.executemany(
-                '''
-                INSERT INTO disambiguator_to_pos (disambiguator, pos)
-                VALUES (?, ?)
-                ''',
-                intersected_cases)
+            new_cases = intersected_cases
             if not intersected_cases:
                 # TODO: maybe solve set cover instead?
                 remaining_cases = [
@@ -276,15 +431,136 @@ def associate_disambiguator_and_pos(args):
                     in disambiguator_pos_mappings
                     for disambiguator in disambiguators
                     for po in pos]
-                c.executemany(
-                    '''
-                    INSERT INTO disambiguator_to_pos (disambiguator, pos)
-                    VALUES (?, ?)
-                    ''',
-                    remaining_cases)
+                new_cases = remaining_cases
                 if not remaining_cases:
                     break
 
+        mapping.extend(new_cases)
+        for disambiguator, po in new_cases:
+            pos_by_disambiguator[disambiguator].add(po)
+            lemmas = lemmas_by_disambiguator[disambiguator]
+            for lemma in [lemma for lemma in lemmas if po in pos_set_by_lemma[lemma]]:
+                lemmas.discard(lemma)
+                unmatched[lemma].discard(disambiguator)
+                if not unmatched[lemma]:
+                    del unmatched[lemma]
+
+    with stats.timer('associate insert'):
+        c.executemany(
+            '''
+            INSERT INTO disambiguator_to_pos (disambiguator, pos)
+            VALUES (?, ?)
+            ''',
+            mapping)
+
+
+#: Raw deflate, since a gloss is too short to spare bytes for headers.
+GLOSS_WBITS = -15
+
+
+def train_gloss_dictionary(glosses, size=32768):
+    """
+    Picks the lines that occur in several glosses and would save the most
+    bytes as a preset dictionary for compressing glosses, up to the size of
+    the deflate window. The most valuable lines come last, where matches
+    against them are the shortest to encode.
+    """
+    counts = collections.Counter(
+        line
+        for gloss in glosses
+        for line in set(gloss.split('\n'))
+        if line)
+    dictionary = []
+    total = 0
+    for line, count in sorted(
+            counts.items(),
+            key=lambda item: (-item[1] * len(item[0].encode()), item[0])):
+        if count < 2:
+            continue
+        encoded = line.encode() + b'\n'
+        if total + len(encoded) > size:
+            break
+        dictionary.append(encoded)
+        total += len(encoded)
+    return b''.join(reversed(dictionary))
+
+
+def compress_gloss(compressor, gloss):
+    compressor = compressor.copy()
+    return compressor.compress(gloss.encode()) + compressor.flush()
+
+
+@functools.lru_cache(maxsize=4096)
+def decompress_gloss(dictionary, gloss):
+    """
+    Returns the text of a gloss compressed against the preset ``dictionary``
+    stored in the gloss_dictionary table, or ``gloss`` itself if the glosses
+    are stored as text (no ``dictionary``).
+    """
+    if dictionary is None:
+        return gloss
+    decompressor = zlib.decompressobj(GLOSS_WBITS, zdict=dictionary)
+    return decompressor.decompress(gloss).decode()
+
+
+USED_GLOSSES_QUERY = '''
+    SELECT
+        entry.lemma AS lemma,
+        used.disambiguator AS disambiguator,
+        gloss.lang AS lang,
+        gloss.gloss AS gloss
+    FROM (
+        SELECT DISTINCT
+            CASE WHEN instr(text, '-')
+                THEN substr(text, 1, instr(text, '-') - 1)
+                ELSE text
+            END AS lemma,
+            disambiguator
+        FROM sentences.lemma) AS used
+        JOIN disambiguator_to_pos
+            ON disambiguator_to_pos.disambiguator = used.disambiguator
+        JOIN entry
+            ON entry.lemma = used.lemma
+            AND entry.pos = disambiguator_to_pos.pos
+        JOIN gloss
+            ON gloss.ent_seq = entry.ent_seq
+            AND gloss.variant = entry.variant
+    '''
+
+
+def build_lemma_gloss(compress=False):
+    """
+    Stores the glosses for every lemma and disambiguator in the sentence
+    database, so that looking them up doesn't need to join entries and parts
+    of speech. Lemmas are matched without the suffix after '-', like in
+    ``spoon.get_dictionary_gloss``.
+
+    With ``compress``, glosses are stored as deflate blobs against a preset
+    dictionary trained on them, which is kept in the gloss_dictionary table.
+    """
+    c = conn.cursor()
+    gloss = 'gloss'
+    if compress:
+        with stats.timer('train gloss dictionary'):
+            dictionary = train_gloss_dictionary(
+                gloss for (gloss,)
+                in c.execute(f'SELECT DISTINCT gloss FROM ({USED_GLOSSES_QUERY})'))
+        c.execute('CREATE TABLE gloss_dictionary (dictionary blob)')
+        c.execute('INSERT INTO gloss_dictionary (dictionary) VALUES (?)', (dictionary,))
+        compressor = zlib.compressobj(9, zlib.DEFLATED, GLOSS_WBITS, zdict=dictionary)
+        conn.create_function(
+            'compress_gloss', 1, functools.partial(compress_gloss, compressor),
+            deterministic=True)
+        gloss = 'compress_gloss(gloss)'
+    c.execute(
+        f'''
+        INSERT OR IGNORE INTO lemma_gloss (lemma, disambiguator, lang, gloss)
+        SELECT lemma, disambiguator, lang, {gloss}
+        FROM ({USED_GLOSSES_QUERY})
+        ORDER BY 1, 2, 3, 4
+        ''')
+    stats.add('lemma glosses', c.rowcount)
+
 
 def convert(args):
     try:
@@ -298,24 +574,28 @@ def convert(args):
     create_tables()
 
     c = conn.cursor()
+    c.execute('ATTACH DATABASE ? AS sentences', (args.sentence_database,))
     for d in (args.jmnedict, args.jmdict):
-        for (ent_seq, variant, kanji, pos, lang, gloss) in read_dictionary(d):
-            c.execute(
-                '''
-                INSERT OR IGNORE INTO entry (ent_seq, variant, lemma, pos)
-                VALUES (?, ?, ?, ?)
-                ''',
-                (ent_seq, variant, kanji, pos))
-            c.execute(
-                '''
-                INSERT OR IGNORE INTO gloss (ent_seq, variant, lang, gloss)
-                VALUES (?, ?, ?, ?)
-                ''',
-                (ent_seq, variant, lang, gloss))
+        if args.processes > 1:
+            rows = read_dictionary_in_parallel(d, args.processes)
+        else:
+            rows = read_dictionary(d)
+        insert_rows(c, stats.timed(f'parse {os.path.basename(d)}', rows, 'rows'))
+
+    with stats.timer('index'):
+        c.execute(
+            '''
+            CREATE INDEX entry_lemma_pos_index ON entry (lemma, pos)
+            ''')
+
+    with stats.timer('associate'):
+        associate_disambiguator_and_pos()
 
-    associate_disambiguator_and_pos(args)
+    with stats.timer('lemma gloss'):
+        build_lemma_gloss(args.compress_glosses)
 
-    conn.commit()
+    with stats.timer('commit'):
+        conn.commit()
 
 
 def main(argv):
@@ -326,9 +606,16 @@ def main(argv):
     parser.add_argument('--jmnedict', type=str, default='data/jmdict/JMnedict.xml.gz')
     parser.add_argument('--database', type=str, default='data/jpn_dictionary.sqlite')
     parser.add_argument('--sentence-database', type=str, default='data/jpn_sentences.sqlite')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='number of processes to parse and format entries with')
+    parser.add_argument('--compress-glosses', action='store_true',
+                        help='store glosses compressed against a shared preset dictionary')
+    build_stats.add_arguments(parser)
     args = parser.parse_args(argv[1:])
 
+    stats.interval = args.progress_interval
     globals()[args.command[0].replace('-', '_')](args)
+    stats.report(args.stats_report)
 
 
 if __name__ == '__main__':
@@ -17,6 +17,7 @@
 #   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+from array import array
 from collections import OrderedDict
 from enum import Enum
 import os
@@ -25,6 +26,9 @@ import sqlite3
 import subprocess
 import sys
 
+import build_stats
+from build_stats import BuildStats, set_bulk_load_pragmas
+
 
 JULIANDAY_OFFSET = 2451542
 JULIANDAY_RELATIVE = f"(julianday('now') - {JULIANDAY_OFFSET})"
@@ -52,7 +56,15 @@ ALL_TABLES_KINDS = sorted(set(
     for tk in review_type.tables_kinds))
 
 
-def create_link_table(cursor, table1, table2):
+DETAIL_TABLES = (
+    ('lemma', ('text', 'disambiguator')),
+    ('grammar', ('form',)),
+    ('grapheme', ('text',)),
+    ('pronunciation', ('word', 'pronunciation')),
+    ('sound', ('text',)))
+
+
+def create_link_table(cursor, table1, table2, indexes=True):
     cursor.execute(
         f'''
         CREATE TABLE IF NOT EXISTS {table1}_{table2} (
@@ -60,6 +72,11 @@ def create_link_table(cursor, table1, table2):
             {table2}_id integer REFERENCES {table2}(id),
             UNIQUE ({table1}_id, {table2}_id))
         ''')
+    if indexes:
+        create_link_indexes(cursor, table1, table2)
+
+
+def create_link_indexes(cursor, table1, table2):
     cursor.execute(
         f'''
         CREATE INDEX IF NOT EXISTS {table1}_{table2}_idx
@@ -72,7 +89,7 @@ def create_link_table(cursor, table1, table2):
         ''')
 
 
-def create_tables(cursor):
+def create_tables(cursor, link_indexes=True):
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS sentence (
@@ -100,7 +117,7 @@ def create_tables(cursor):
             frequency real,
             UNIQUE (text, disambiguator))
         ''')
-    create_link_table(cursor, 'sentence', 'lemma')
+    create_link_table(cursor, 'sentence', 'lemma', link_indexes)
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS grammar (
@@ -110,7 +127,7 @@ def create_tables(cursor):
             last_relearn real,
             frequency real)
         ''')
-    create_link_table(cursor, 'sentence', 'grammar')
+    create_link_table(cursor, 'sentence', 'grammar', link_indexes)
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS grapheme (
@@ -120,7 +137,7 @@ def create_tables(cursor):
             last_relearn real,
             frequency real)
         ''')
-    create_link_table(cursor, 'sentence', 'grapheme')
+    create_link_table(cursor, 'sentence', 'grapheme', link_indexes)
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS pronunciation (
@@ -134,7 +151,7 @@ def create_tables(cursor):
             frequency real,
             UNIQUE (word, pronunciation))
         ''')
-    create_link_table(cursor, 'sentence', 'pronunciation')
+    create_link_table(cursor, 'sentence', 'pronunciation', link_indexes)
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS sound (
@@ -144,7 +161,7 @@ def create_tables(cursor):
             last_relearn real,
             frequency real)
         ''')
-    create_link_table(cursor, 'sentence', 'sound')
+    create_link_table(cursor, 'sentence', 'sound', link_indexes)
     cursor.execute(
         '''
         CREATE TABLE IF NOT EXISTS totals (
@@ -187,54 +204,421 @@ def create_tables(cursor):
 FURIGANA_PATTERN = re.compile(r'\[([^|]+)\|([^\]]+)\]')
 
 
-def read_sentences(filename):
-    with open(filename) as f:
-        with subprocess.Popen(
-                ['java', '-jar', 'kuromoji/target/kuromoji-1.0-jar-with-dependencies.jar'],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                bufsize=1,  # line buffered
-                universal_newlines=True
-        ) as kuromoji:
-            for line in f:
-                line = line.rstrip('\n')
-                source_database, source_url, source_id, license_url, creator, sentence = line.split('\t')
-                kuromoji.stdin.write(sentence+'\n')
-                sentence = FURIGANA_PATTERN.sub('\\1', sentence)
-                analyzed = ''
-                segmented = []
-                pronounced = []
-                based = []
-                grammared = []
+stats = BuildStats('jpn_data')
+
+
+KUROMOJI_COMMAND = ['java', '-jar', 'kuromoji/target/kuromoji-1.0-jar-with-dependencies.jar']
+
+
+class Kuromoji:
+    """
+    A pool of Kuromoji processes. Sentences are distributed over the workers
+    in round-robin batches written by a separate thread, so that
+    tokenization overlaps with whatever the consumer does with the results,
+    which are nevertheless returned in input order. The analysis of each input
+    line ends with an ``EOS`` line, which is used to delimit the output instead
+    of waiting for the analyzed surface to match the input.
+    """
+
+    FLUSH = object()
+
+    def __init__(self, workers=1, batch_size=64):
+        self.workers = max(workers, 1)
+        self.batch_size = batch_size
+        self.processes = []
+
+    def start(self):
+        # Started on first use, so that fully cached runs don't pay for the JVM.
+        if not self.processes:
+            self.processes = [
+                subprocess.Popen(
+                    KUROMOJI_COMMAND,
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    universal_newlines=True)
+                for _ in range(self.workers)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for process in self.processes:
+            if exc_type is not None:
+                process.kill()
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+            process.wait()
+            process.stdout.close()
+
+    def tokenize(self, items):
+        """
+        Takes tuples whose last element is the text to analyze and yields
+        ``(item, rows)`` pairs, where ``rows`` are the lines of Kuromoji output
+        for that text. Where ``items`` would block until some of those results
+        are consumed, it has to yield ``Kuromoji.FLUSH`` first, so that the
+        texts still sitting in a partial batch are sent to the workers.
+        """
+        import queue
+        import threading
+
+        self.start()
+        pending = queue.Queue()
+        feeder_error = None
+
+        def feed():
+            nonlocal feeder_error
+            try:
+                i = 0
+                for item in items:
+                    if item is Kuromoji.FLUSH:
+                        for process in self.processes:
+                            process.stdin.flush()
+                        continue
+                    # Each worker gets whole batches and is flushed as soon as
+                    # its own batch is complete, instead of waiting for the
+                    # others to fill theirs.
+                    batch, position = divmod(i, self.batch_size)
+                    i += 1
+                    worker = batch % len(self.processes)
+                    pending.put((item, worker))
+                    # Line breaks inside the text would break the framing.
+                    text = item[-1].replace('\r', ' ').replace('\n', ' ')
+                    stdin = self.processes[worker].stdin
+                    stdin.write(text + '\n')
+                    if position == self.batch_size - 1:
+                        stdin.flush()
+                for process in self.processes:
+                    process.stdin.flush()
+            except BrokenPipeError:
+                pass  # reported by the reader as an unexpected exit
+            except BaseException as e:
+                feeder_error = e
+            finally:
+                pending.put(None)
+
+        feeder = threading.Thread(target=feed, daemon=True)
+        feeder.start()
+        while True:
+            entry = pending.get()
+            if entry is None:
+                break
+            item, worker = entry
+            stdout = self.processes[worker].stdout
+            rows = []
+            with stats.timer('kuromoji wait'):
                 while True:
-                    if analyzed == sentence:
+                    row = stdout.readline()
+                    if not row:
+                        raise RuntimeError(
+                            f'Kuromoji worker {worker} exited while analyzing {item[-1]!r}')
+                    row = row.rstrip('\n')
+                    if row == 'EOS':
                         break
-                    row = kuromoji.stdout.readline().rstrip('\n')
-                    if not row or row == 'EOS':
-                        continue
-                    word, analysis = row.split('\t')
-                    pos1, pos2, pos3, pos4, conjugation, form, base, pronunciation = analysis.split(',')
-                    disambiguator = ','.join(
-                        pos for pos in (
-                            pos1 if pos1 not in pos2 else '*',
-                            pos2, pos3, pos4)
-                        if pos != '*')
-                    grammar = ','.join(
-                        part for part in (
-                            pos1 if pos1 not in conjugation else '*',
-                            conjugation, form)
-                        if part != '*')
-                    analyzed += word
-                    segmented.append(word)
-                    if pronunciation == '*':
-                        pronunciation = word
-                    pronounced.append(pronunciation)
-                    if base == '*':
-                        base = word
-                    based.append((base, disambiguator))
-                    grammared.append(grammar)
-                yield (source_database, source_url, source_id, license_url, creator,
-                       sentence, segmented, pronounced, based, grammared)
+                    if row:
+                        rows.append(row)
+            stats.add('tokenized sentences')
+            yield item, rows
+        feeder.join()
+        if feeder_error is not None:
+            raise feeder_error
+
+
+class TokenizationCache:
+    """
+    Kuromoji output stored by input text and version of the Kuromoji jar
+    (which includes the dictionary), so that rebuilding the database only needs
+    to tokenize sentences that weren't seen before. The raw output is stored
+    rather than the result of ``analyze`` so that changes to the latter take
+    effect without invalidating the cache.
+    """
+
+    def __init__(self, filename):
+        self.version = kuromoji_version()
+        # May be shared by several builds running in parallel.
+        self.conn = sqlite3.connect(filename, timeout=600)
+        self.conn.execute('PRAGMA journal_mode = WAL')
+        self.conn.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS tokenization (
+                version text,
+                text text,
+                rows text,
+                PRIMARY KEY (version, text))
+            WITHOUT ROWID
+            ''')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.conn.commit()
+        self.conn.close()
+
+    def lookup(self, text):
+        for (rows,) in self.conn.execute(
+                'SELECT rows FROM tokenization WHERE version = ? AND text = ?',
+                (self.version, text)):
+            return rows.split('\n') if rows else []
+        return None
+
+    def tokenize(self, kuromoji, items, chunk_size=4096):
+        """
+        Like ``Kuromoji.tokenize``, but only cache misses are sent to Kuromoji.
+        Items are looked up a chunk at a time, one chunk ahead of the results
+        being yielded, and all misses go through a single call of
+        ``Kuromoji.tokenize``, so that the workers don't idle between chunks.
+        """
+        from itertools import islice
+        import queue
+
+        misses = queue.Queue()
+
+        def queued_misses():
+            while True:
+                try:
+                    chunk_misses = misses.get_nowait()
+                except queue.Empty:
+                    # The next chunk is only looked up once the results for
+                    # this one have been consumed.
+                    yield Kuromoji.FLUSH
+                    chunk_misses = misses.get()
+                if chunk_misses is None:
+                    break
+                yield from chunk_misses
+
+        def look_up(chunk):
+            with stats.timer('cache lookup'):
+                chunk = [(item, self.lookup(item[-1])) for item in chunk]
+            chunk_misses = [item for item, rows in chunk if rows is None]
+            stats.add('cache misses', len(chunk_misses))
+            stats.add('cache hits', len(chunk) - len(chunk_misses))
+            if chunk_misses:
+                misses.put(chunk_misses)
+            return chunk, bool(chunk_misses)
+
+        # Not started until the first miss, so that fully cached runs don't
+        # start Kuromoji at all.
+        tokenized = kuromoji.tokenize(queued_misses())
+        started = False
+        items = iter(items)
+        try:
+            chunk, missed = look_up(list(islice(items, chunk_size)))
+            while chunk:
+                next_chunk, next_missed = look_up(list(islice(items, chunk_size)))
+                if not next_chunk:
+                    misses.put(None)
+                started = started or missed
+                new_rows = []
+                for item, rows in chunk:
+                    if rows is None:
+                        _, rows = next(tokenized)
+                        new_rows.append((self.version, item[-1], '\n'.join(rows)))
+                    yield item, rows
+                with stats.timer('cache update'):
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO tokenization VALUES (?, ?, ?)',
+                        new_rows)
+                    self.conn.commit()
+                chunk, missed = next_chunk, next_missed
+        finally:
+            # Lets the feeder finish, also when the consumer stopped early.
+            misses.put(None)
+        if started:
+            for _ in tokenized:
+                pass  # let the tokenizer finish cleanly
+
+
+def kuromoji_version():
+    import hashlib
+
+    digest = hashlib.sha1()
+    with open(KUROMOJI_COMMAND[-1], 'rb') as jar:
+        for block in iter(lambda: jar.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def analyze(rows):
+    segmented = []
+    pronounced = []
+    based = []
+    grammared = []
+    for row in rows:
+        word, analysis = row.split('\t')
+        pos1, pos2, pos3, pos4, conjugation, form, base, pronunciation = analysis.split(',')
+        disambiguator = ','.join(
+            pos for pos in (
+                pos1 if pos1 not in pos2 else '*',
+                pos2, pos3, pos4)
+            if pos != '*')
+        grammar = ','.join(
+            part for part in (
+                pos1 if pos1 not in conjugation else '*',
+                conjugation, form)
+            if part != '*')
+        segmented.append(word)
+        if pronunciation == '*':
+            pronunciation = word
+        pronounced.append(pronunciation)
+        if base == '*':
+            base = word
+        based.append((base, disambiguator))
+        grammared.append(grammar)
+    return segmented, pronounced, based, grammared
+
+
+def read_sentence_table_from(filename, offset):
+    """
+    Reads the sentence table starting at the given byte offset. Each row is
+    preceded by the offset of the line after it, where reading can be resumed.
+    """
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            offset += len(line)
+            yield (offset, *line.decode('utf-8').rstrip('\r\n').split('\t'))
+
+
+def produce(queue, source, source_args, batch_size=256):
+    """
+    Runs a sentence source in a separate process, handing its rows over in
+    batches through a bounded queue.
+    """
+    import traceback
+
+    try:
+        batch = []
+        for row in source(*source_args):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                queue.put(batch)
+                batch = []
+        queue.put(batch)
+        queue.put(None)
+    except BaseException:
+        queue.put(traceback.format_exc())
+
+
+def stream_sentences(sources, queue_size=64):
+    """
+    Yields the rows of each source in turn, while all of them run concurrently
+    in their own processes, each at most ``queue_size`` batches ahead.
+    """
+    import multiprocessing
+
+    queues = []
+    processes = []
+    for source, source_args in sources:
+        queue = multiprocessing.Queue(queue_size)
+        # Not daemonic, so that a source can run a pool of its own.
+        process = multiprocessing.Process(
+            target=produce, args=(queue, source, source_args))
+        process.start()
+        queues.append(queue)
+        processes.append(process)
+    try:
+        for queue in queues:
+            while True:
+                batch = queue.get()
+                if batch is None:
+                    break
+                if isinstance(batch, str):
+                    raise RuntimeError(f'Sentence source failed:\n{batch}')
+                yield from (tuple(row) for row in batch)
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def sentence_sources(args):
+    import aozora_data
+    import tatoeba_data
+
+    return [
+        (tatoeba_data.filtered_sentences,
+         (args.tatoeba_database, args.tatoeba_language, args.minimum_level)),
+        (aozora_data.sentences_from_files,
+         (args.aozora_files, args.aozora_processes, args.extraction_cache))]
+
+
+def read_input_from(args, offset):
+    """
+    Like ``read_sentence_table_from``, but with ``--stream`` the rows come
+    straight from Tatoeba and Aozora instead of the sentence table, and the
+    offset counts rows rather than bytes.
+    """
+    if args.stream:
+        rows = stream_sentences_from(args, offset)
+    else:
+        rows = read_sentence_table_from(args.sentence_table, offset)
+    return stats.timed('read input', rows, 'input rows')
+
+
+def stream_sentences_from(args, offset):
+    from itertools import islice
+
+    for offset, (*metadata, sentence) in enumerate(
+            islice(stream_sentences(sentence_sources(args)), offset, None),
+            offset + 1):
+        # Tatoeba sentences may contain line breaks, which can't be tokenized.
+        yield (offset, *metadata, sentence.replace('\r', ' ').replace('\n', ' '))
+
+
+def input_version(args):
+    if not args.stream:
+        return args.sentence_table, os.path.getmtime(args.sentence_table)
+    return 'stream', max(
+        os.path.getmtime(args.tatoeba_database),
+        os.path.getmtime(args.aozora_files))
+
+
+def tokenize_sentences(items, kuromoji_workers=1, cache_filename=None):
+    import contextlib
+
+    with contextlib.ExitStack() as exit_stack:
+        kuromoji = exit_stack.enter_context(Kuromoji(kuromoji_workers))
+        if cache_filename:
+            cache = exit_stack.enter_context(TokenizationCache(cache_filename))
+            tokenized = cache.tokenize(kuromoji, items)
+        else:
+            tokenized = kuromoji.tokenize(items)
+        for item, rows in tokenized:
+            # Any fields before the sentence are passed through unchanged.
+            *metadata, sentence = item
+            sentence = FURIGANA_PATTERN.sub('\\1', sentence)
+            with stats.timer('analyze'):
+                analysis = analyze(rows)
+            yield (*metadata, sentence, *analysis)
+
+
+def unique_sentences(items, seen=None):
+    """
+    Drops repeated sentences before they reach the tokenizer. Only the first
+    occurrence would be stored anyway.
+    """
+    if seen is None:
+        seen = set()
+    for item in items:
+        text = FURIGANA_PATTERN.sub('\\1', item[-1])
+        if text not in seen:
+            seen.add(text)
+            yield item
+
+
+def sentence_details(sentence, segmented, pronounced, based, grammared):
+    """
+    The values to be stored in each of the DETAIL_TABLES for a sentence, in
+    the same order.
+    """
+    return (
+        based,
+        [(g,) for g in grammared],
+        [(w,) for w in sentence],
+        list(zip(segmented, pronounced)),
+        [(c,) for p in pronounced for c in p])
 
 
 def count_or_create(cursor, table, fields, values, frequency_field='frequency'):
@@ -272,6 +656,178 @@ def count_or_create_and_link(cursor, table1, table2, fields1, fields2, values1,
     create_links(cursor, table1, table2, fields1, fields2, values1, values2)
 
 
+def add_sentences(cursor, sentences):
+    for (source_database, source_url, source_id, license_url, creator,
+         sentence, segmented, pronounced, based, grammared
+         ) in sentences:
+        with stats.timer('sqlite'):
+            unsegmented_text = ''.join(segmented)
+            joined_segmentation = '\t'.join(segmented)
+            joined_pronunciation = '\t'.join(pronounced)
+            cursor.execute(
+                '''
+                INSERT OR IGNORE INTO sentence (
+                    text, segmented_text, pronunciation, source_database, source_url,
+                    source_id, license_url, creator) VALUES (?,?,?,?,?,?,?,?)
+                ''',
+                (unsegmented_text, joined_segmentation, joined_pronunciation,
+                 source_database, source_url, source_id, license_url, creator))
+            if cursor.rowcount == 0:
+                # Already stored, possibly from input which the tokenizer
+                # reduced to the same text. Its details were counted then.
+                continue
+            sentence_id = [(cursor.lastrowid,)]
+            for (table, fields), values in zip(
+                    DETAIL_TABLES,
+                    sentence_details(sentence, segmented, pronounced, based, grammared)):
+                count_or_create_and_link(
+                    cursor,
+                    'sentence', table,
+                    ('id',), fields,
+                    sentence_id, values)
+        stats.add('stored sentences')
+
+
+class DetailAggregator:
+    """
+    Collects sentences and their details in memory instead of issuing several
+    statements per sentence. Each distinct detail is interned into an integer
+    id, frequencies and links are accumulated in compact arrays and everything
+    is written to the database in bulk by ``load``.
+    """
+
+    def __init__(self):
+        self.sentences = []
+        self.sentence_ids = {}
+        self.detail_ids = tuple({} for _ in DETAIL_TABLES)
+        self.frequencies = tuple(array('q') for _ in DETAIL_TABLES)
+        # (sentence_id, detail_id) pairs, flattened
+        self.links = tuple(array('q') for _ in DETAIL_TABLES)
+
+    def add(self, source_database, source_url, source_id, license_url, creator,
+            sentence, segmented, pronounced, based, grammared):
+        unsegmented_text = ''.join(segmented)
+        if unsegmented_text in self.sentence_ids:
+            return
+        sentence_id = len(self.sentences) + 1
+        self.sentence_ids[unsegmented_text] = sentence_id
+        self.sentences.append((
+            sentence_id, unsegmented_text, '\t'.join(segmented), '\t'.join(pronounced),
+            source_database, source_url, source_id, license_url, creator))
+        for i, values in enumerate(
+                sentence_details(sentence, segmented, pronounced, based, grammared)):
+            frequencies = self.frequencies[i]
+            links = self.links[i]
+            for value in dict.fromkeys(values):
+                detail_id = self.intern(i, value)
+                frequencies[detail_id - 1] += 1
+                links.append(sentence_id)
+                links.append(detail_id)
+
+    def intern(self, i, value):
+        ids = self.detail_ids[i]
+        detail_id = ids.get(value)
+        if detail_id is None:
+            detail_id = ids[value] = len(ids) + 1
+            self.frequencies[i].append(0)
+        return detail_id
+
+    def merge(self, cursor):
+        """
+        Adds the sentences, details and links of a partial database, mapping
+        its ids to ours and summing frequencies. Sentences which are already
+        present are skipped and not counted twice.
+        """
+        sentence_map = {}
+        for (id, text, *rest) in cursor.execute(
+                '''
+                SELECT
+                    id, text, segmented_text, pronunciation, source_database,
+                    source_url, source_id, license_url, creator
+                FROM sentence
+                ORDER BY id
+                '''):
+            if text in self.sentence_ids:
+                continue
+            sentence_id = len(self.sentences) + 1
+            self.sentence_ids[text] = sentence_id
+            self.sentences.append((sentence_id, text, *rest))
+            sentence_map[id] = sentence_id
+        for i, (table, fields) in enumerate(DETAIL_TABLES):
+            frequencies = self.frequencies[i]
+            links = self.links[i]
+            detail_map = {}
+            for (id, *value, frequency) in cursor.execute(
+                    f'''
+                    SELECT id, {', '.join(fields)}, frequency
+                    FROM {table}
+                    '''):
+                detail_id = detail_map[id] = self.intern(i, tuple(value))
+                frequencies[detail_id - 1] += int(frequency)
+            for (sentence_id, id) in cursor.execute(
+                    f'''
+                    SELECT sentence_id, {table}_id
+                    FROM sentence_{table}
+                    ORDER BY sentence_id
+                    '''):
+                if sentence_id in sentence_map:
+                    links.append(sentence_map[sentence_id])
+                    links.append(detail_map[id])
+                else:
+                    frequencies[detail_map[id] - 1] -= 1
+
+    def load(self, cursor, link_indexes=True):
+        """
+        Rows are first appended to staging tables without any constraints or
+        indexes and then copied into the real tables sorted by their unique
+        keys, so that those indexes are built in order instead of by random
+        insertion. The remaining indexes on the link tables are created last.
+        """
+        bulk_insert(
+            cursor, 'sentence',
+            ('id', 'text', 'segmented_text', 'pronunciation', 'source_database',
+             'source_url', 'source_id', 'license_url', 'creator'),
+            self.sentences,
+            'id')
+        for (table, fields), ids, frequencies, links in zip(
+                DETAIL_TABLES, self.detail_ids, self.frequencies, self.links):
+            bulk_insert(
+                cursor, table,
+                ('id',) + fields + ('frequency',),
+                ((detail_id, *value, frequencies[detail_id - 1])
+                 for value, detail_id in ids.items()),
+                ', '.join(fields))
+            pairs = iter(links)
+            bulk_insert(
+                cursor, f'sentence_{table}',
+                ('sentence_id', f'{table}_id'),
+                zip(pairs, pairs),
+                f'sentence_id, {table}_id')
+            if link_indexes:
+                create_link_indexes(cursor, 'sentence', table)
+
+
+def bulk_insert(cursor, table, columns, rows, order_by):
+    cursor.execute(
+        f'''
+        CREATE TEMPORARY TABLE staging_{table} ({', '.join(columns)})
+        ''')
+    cursor.executemany(
+        f'''
+        INSERT INTO staging_{table}
+        VALUES ({', '.join('?' for c in columns)})
+        ''',
+        rows)
+    cursor.execute(
+        f'''
+        INSERT INTO {table} ({', '.join(columns)})
+        SELECT {', '.join(columns)}
+        FROM staging_{table}
+        ORDER BY {order_by}
+        ''')
+    cursor.execute(f'DROP TABLE staging_{table}')
+
+
 def update_total_frequency(cursor, table):
     cursor.execute(
         f'''
@@ -518,8 +1074,7 @@ def transfer_memory(cursor, old_database):
     cursor.execute('INSERT INTO log SELECT * from old_data.log')
 
 
-def build_database(args):
-    # First check for bugs
+def check_sqlite_version():
     if sqlite3.sqlite_version_info < (3, 30, 0):
         has_bug = sqlite3.sqlite_version_info <= (3, 27, 2)
         if not has_bug:
@@ -537,55 +1092,9 @@ def build_database(args):
                 file=sys.stderr)
             sys.exit(1)
 
-    conn = sqlite3.connect(args.database)
-    cursor = conn.cursor()
-    create_tables(cursor)
-    previous_sentence_id = None
-    for (source_database, source_url, source_id, license_url, creator,
-         sentence, segmented, pronounced, based, grammared
-         ) in read_sentences(args.sentence_table):
-        unsegmented_text = ''.join(segmented)
-        joined_segmentation = '\t'.join(segmented)
-        joined_pronunciation = '\t'.join(pronounced)
-        cursor.execute(
-            '''
-            INSERT OR IGNORE INTO sentence (
-                text, segmented_text, pronunciation, source_database, source_url,
-                source_id, license_url, creator) VALUES (?,?,?,?,?,?,?,?)
-            ''',
-            (unsegmented_text, joined_segmentation, joined_pronunciation,
-             source_database, source_url, source_id, license_url, creator))
-        sentence_id = [next(cursor.execute('SELECT last_insert_rowid() FROM sentence'))]
-        if sentence_id == previous_sentence_id:
-            continue
-        previous_sentence_id = sentence_id
-        count_or_create_and_link(
-            cursor,
-            'sentence', 'lemma',
-            ('id',), ('text', 'disambiguator'),
-            sentence_id, based)
-        count_or_create_and_link(
-            cursor,
-            'sentence', 'grammar',
-            ('id',), ('form',),
-            sentence_id, [(g,) for g in grammared])
-        count_or_create_and_link(
-            cursor,
-            'sentence', 'grapheme',
-            ('id',), ('text',),
-            sentence_id, [(w,) for w in sentence])
-        count_or_create_and_link(
-            cursor,
-            'sentence', 'pronunciation',
-            ('id',), ('word', 'pronunciation'),
-            sentence_id, list(zip(segmented, pronounced)))
-        count_or_create_and_link(
-            cursor,
-            'sentence', 'sound',
-            ('id',), ('text',),
-            sentence_id, [(c,) for p in pronounced for c in p])
-    tables = ('lemma', 'grammar', 'grapheme', 'pronunciation', 'sound')
-    for table in tables:
+
+def update_totals(cursor):
+    for table, fields in DETAIL_TABLES:
         update_total_frequency(cursor, table)
     cursor.execute(
         f'''
@@ -593,6 +1102,10 @@ def build_database(args):
         SET total_sentences = (SELECT count(*) FROM sentence)
         WHERE id = 0
         ''')
+
+
+def create_triggers(cursor):
+    tables = tuple(table for table, fields in DETAIL_TABLES)
     kindses = (('',), ('',), ('',), ('forward_', 'backward_'), ('',))
     for table, kinds in zip(tables, kindses):
         create_learn_trigger(cursor, table, kinds)
@@ -628,6 +1141,9 @@ def build_database(args):
             WHERE sentence_id = NEW.id;
         END
         ''')
+
+
+def update_minimum_unknown_frequency(cursor, condition='1'):
     cursor.execute(
         f'''
         UPDATE sentence SET
@@ -649,22 +1165,429 @@ def build_database(args):
                     for table, kind in ALL_TABLES_KINDS)})
                 ORDER BY frequency ASC
                 LIMIT 1)
+        WHERE {condition}
         ''')
+
+
+def create_progress_table(cursor):
+    cursor.execute(
+        '''
+        CREATE TABLE IF NOT EXISTS progress (
+            id integer PRIMARY KEY CHECK (id = 0),
+            sentence_table text,
+            sentence_table_mtime real,
+            input_offset integer,
+            loaded integer,
+            finished integer)
+        ''')
+
+
+def read_progress(args):
+    '''
+    Returns the input offset, loaded and finished flags recorded in the
+    progress database, which is created for a new build.
+    '''
+    progress = sqlite3.connect(args.database + '.progress')
+    cursor = progress.cursor()
+    create_progress_table(cursor)
+    version = input_version(args)
+    cursor.execute(
+        '''
+        INSERT OR IGNORE INTO progress
+        VALUES (0, ?, ?, 0, 0, 0)
+        ''',
+        version)
+    progress.commit()
+    (sentence_table, sentence_table_mtime, offset, loaded, finished) = next(cursor.execute(
+        '''
+        SELECT sentence_table, sentence_table_mtime, input_offset, loaded, finished
+        FROM progress
+        '''))
+    progress.close()
+    if (sentence_table, sentence_table_mtime) != version and not finished:
+        print(
+            f'{version[0]} changed since the interrupted build started. '
+            f'Delete {args.database}.progress to start over.',
+            file=sys.stderr)
+        sys.exit(1)
+    return offset, loaded, finished
+
+
+def load_with_checkpoints(args, offset, loaded):
+    '''
+    The first stage of the build: tokenize the input straight into the
+    database. Every ``checkpoint_interval`` sentences, the input offset reached
+    is committed to the attached progress database in the same transaction as
+    the sentences themselves, so that an interrupted build can continue from
+    there instead of from the first line. Nothing but that offset is kept on
+    the side.
+    '''
+    if not (offset or loaded) and os.path.exists(args.database):
+        os.remove(args.database)
+    conn = sqlite3.connect(args.database)
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS build', (args.database + '.progress',))
+    if loaded:
+        return conn
+    if offset:
+        print(f'Resuming build from {input_version(args)[0]} at {offset}', file=sys.stderr)
+        # Only spares tokenizing input which is stored as-is. Input which
+        # Kuromoji reduces to a stored text is tokenized again and then
+        # skipped by add_sentences.
+        seen = set(text for (text,) in cursor.execute('SELECT text FROM sentence'))
+    else:
+        create_tables(cursor)
+        seen = set()
+
+    def checkpointed(rows):
+        # A row has been added once add_sentences asks for the next one.
+        for i, (offset, *row) in enumerate(rows, 1):
+            yield row
+            if i % args.checkpoint_interval == 0:
+                with stats.timer('checkpoint'):
+                    cursor.execute('UPDATE build.progress SET input_offset = ?', (offset,))
+                    conn.commit()
+
+    add_sentences(cursor, checkpointed(tokenize_sentences(
+        unique_sentences(read_input_from(args, offset), seen),
+        args.kuromoji_workers, args.tokenization_cache)))
+    cursor.execute('UPDATE build.progress SET loaded = 1')
+    conn.commit()
+    return conn
+
+
+def aggregate_tokenized(items, args):
+    aggregator = DetailAggregator()
+    for row in tokenize_sentences(items, args.kuromoji_workers, args.tokenization_cache):
+        with stats.timer('aggregate'):
+            aggregator.add(*row)
+        stats.add('aggregated sentences')
+    return aggregator
+
+
+def queued_items(queue):
+    while True:
+        batch = queue.get()
+        if batch is None:
+            break
+        yield from (tuple(item) for item in batch)
+
+
+def build_shard(args, queue, results):
+    '''
+    Builds the sentence, detail and link tables for the sentences which arrive
+    through the queue and reports its counters, or the error which stopped it,
+    through ``results``.
+    '''
+    import traceback
+
+    global stats
+    # Forked workers inherit the parent's counters, which are reported there.
+    stats = BuildStats(f'jpn_data {os.path.basename(args.database)}', stats.interval)
+    try:
+        aggregator = aggregate_tokenized(queued_items(queue), args)
+        conn = sqlite3.connect(args.database)
+        cursor = conn.cursor()
+        set_bulk_load_pragmas(cursor)
+        create_tables(cursor, link_indexes=False)
+        with stats.timer('load'):
+            aggregator.load(cursor, link_indexes=False)
+            conn.commit()
+        conn.close()
+        results.put(stats.as_dict())
+    except BaseException:
+        results.put(traceback.format_exc())
+
+
+def shard_filenames(args):
+    return [f'{args.database}.shard{i}.sqlite' for i in range(args.shards)]
+
+
+def build_shards(args, batch_size=256, queue_size=64):
+    '''
+    Hands the (deduplicated) input over to one process per shard, in batches
+    dealt round-robin through bounded queues, so that reading, tokenizing and
+    aggregating all overlap. Each process builds a partial database and the
+    results are merged. Since the shards don't overlap, frequencies can simply
+    be summed.
+    '''
+    import copy
+    import multiprocessing
+    import queue as queue_module
+
+    queues = []
+    results = multiprocessing.Queue()
+    processes = []
+    for database in shard_filenames(args):
+        if os.path.exists(database):
+            os.remove(database)
+        shard_args = copy.copy(args)
+        shard_args.database = database
+        queue = multiprocessing.Queue(queue_size)
+        process = multiprocessing.Process(
+            target=build_shard, args=(shard_args, queue, results))
+        process.start()
+        queues.append(queue)
+        processes.append(process)
+
+    def failure():
+        try:
+            error = results.get(timeout=1)
+        except queue_module.Empty:
+            error = 'The process exited without reporting.'
+        return RuntimeError(f'Building a shard failed:\n{error}')
+
+    def put(shard, batch):
+        # A shard which failed stops taking batches, so don't wait on it forever.
+        while True:
+            try:
+                return queues[shard].put(batch, timeout=1)
+            except queue_module.Full:
+                if not processes[shard].is_alive():
+                    raise failure()
+
+    try:
+        batch = []
+        shard = 0
+        for item in unique_sentences(
+                tuple(fields) for offset, *fields in read_input_from(args, 0)):
+            batch.append(item)
+            if len(batch) >= batch_size:
+                put(shard, batch)
+                shard = (shard + 1) % len(queues)
+                batch = []
+        put(shard, batch)
+        for shard in range(len(queues)):
+            put(shard, None)
+        reported = 0
+        while reported < len(processes):
+            try:
+                shard_stats = results.get(timeout=1)
+            except queue_module.Empty:
+                if not any(process.is_alive() for process in processes):
+                    raise failure()
+                continue
+            if isinstance(shard_stats, str):
+                raise RuntimeError(f'Building a shard failed:\n{shard_stats}')
+            stats.merge(shard_stats)
+            reported += 1
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+    aggregator = DetailAggregator()
+    for database in shard_filenames(args):
+        conn = sqlite3.connect(database)
+        with stats.timer('merge'):
+            aggregator.merge(conn.cursor())
+        conn.close()
+        os.remove(database)
+    return aggregator
+
+
+def build_database(args):
+    '''
+    Sequential builds can be resumed after an interruption, see
+    ``load_with_checkpoints``. ``--in-memory`` and ``--shards`` keep their
+    state in memory and start over instead, which is mostly a matter of
+    looking up the tokenization cache again.
+    '''
+    check_sqlite_version()
+
+    progress_filename = args.database + '.progress'
+    bulk = args.shards > 1 or args.in_memory
+    if os.path.exists(args.database) and (bulk or not os.path.isfile(progress_filename)):
+        print(f'{args.database} already exists.', file=sys.stderr)
+        sys.exit(1)
+    if bulk:
+        if args.shards > 1:
+            aggregator = build_shards(args)
+        else:
+            aggregator = aggregate_tokenized(unique_sentences(
+                tuple(fields) for offset, *fields in read_input_from(args, 0)), args)
+        # Written under a temporary name, so that a crash leaves nothing behind.
+        filename = args.database + '.tmp'
+        if os.path.exists(filename):
+            os.remove(filename)
+        conn = sqlite3.connect(filename)
+        cursor = conn.cursor()
+        set_bulk_load_pragmas(cursor)
+        create_tables(cursor, link_indexes=False)
+        with stats.timer('load'):
+            aggregator.load(cursor)
+    else:
+        offset, loaded, finished = read_progress(args)
+        if finished:
+            os.remove(progress_filename)
+            return
+        conn = load_with_checkpoints(args, offset, loaded)
+        cursor = conn.cursor()
+        # The remaining stages run in a single transaction, so after a crash
+        # they are simply redone.
+        cursor.execute('UPDATE build.progress SET finished = 1')
+    with stats.timer('totals'):
+        update_totals(cursor)
+    create_triggers(cursor)
+    with stats.timer('minimum unknown frequency'):
+        update_minimum_unknown_frequency(cursor)
     if args.old_database and os.path.isfile(args.old_database):
-        transfer_memory(cursor, args.old_database)
+        with stats.timer('transfer memory'):
+            transfer_memory(cursor, args.old_database)
+    with stats.timer('commit'):
+        conn.commit()
+    conn.close()
+    if bulk:
+        os.replace(filename, args.database)
+    else:
+        os.remove(progress_filename)
+
+
+def update_database(args):
+    '''
+    Brings an existing database in line with the sentence table without
+    rebuilding it, so that learning progress is kept as-is and no
+    ``transfer_memory`` is needed. Sentences which are new in the table are
+    tokenized and added, sentences which no longer appear in it are retired.
+    Detail frequencies and ``totals`` are adjusted accordingly, and the
+    minimum unknown frequency is recomputed only for sentences sharing an
+    unknown detail with a changed sentence, since no others can be affected.
+    '''
+    check_sqlite_version()
+
+    conn = sqlite3.connect(args.database)
+    cursor = conn.cursor()
+    existing = dict(cursor.execute('SELECT text, id FROM sentence'))
+    (max_id,) = next(cursor.execute('SELECT ifnull(max(id), 0) FROM sentence'))
+
+    new_items = []
+    seen = set()
+    for item in unique_sentences(
+            tuple(fields) for offset, *fields in read_input_from(args, 0)):
+        text = FURIGANA_PATTERN.sub('\\1', item[-1])
+        if text in existing:
+            seen.add(text)
+        else:
+            new_items.append(item)
+
+    def unstored(rows):
+        # The stored text is the joined segmentation, which needn't reproduce
+        # the input exactly, so whether a sentence is new is only certain once
+        # it has been tokenized.
+        for row in rows:
+            text = ''.join(row[-4])
+            seen.add(text)
+            if text not in existing:
+                yield row
+
+    cursor.execute('CREATE TEMPORARY TABLE changed_sentence (id integer PRIMARY KEY)')
+    add_sentences(cursor, unstored(tokenize_sentences(
+        new_items, args.kuromoji_workers, args.tokenization_cache)))
+    retired_ids = [id for text, id in existing.items() if text not in seen]
+    cursor.executemany(
+        'INSERT INTO changed_sentence VALUES (?)',
+        ((id,) for id in retired_ids))
+    cursor.execute(
+        'INSERT INTO changed_sentence SELECT id FROM sentence WHERE id > ?',
+        (max_id,))
+    (added,) = next(cursor.execute('SELECT count(*) FROM sentence WHERE id > ?', (max_id,)))
+
+    cursor.execute('CREATE TEMPORARY TABLE affected_sentence (id integer PRIMARY KEY)')
+    for table, kind in ALL_TABLES_KINDS:
+        cursor.execute(
+            f'''
+            INSERT OR IGNORE INTO affected_sentence
+            SELECT sentence_id
+            FROM sentence_{table}
+            WHERE {table}_id IN (
+                SELECT t.id
+                FROM sentence_{table} AS st, {table} AS t
+                WHERE st.sentence_id IN changed_sentence
+                AND st.{table}_id = t.id
+                AND t.last_{kind}relearn IS NULL)
+            ''')
+
+    cursor.execute('DELETE FROM changed_sentence WHERE id > ?', (max_id,))
+    for table, fields in DETAIL_TABLES:
+        cursor.execute(
+            f'''
+            UPDATE {table}
+            SET frequency = frequency - (
+                SELECT count(*)
+                FROM sentence_{table}
+                WHERE {table}_id = {table}.id
+                AND sentence_id IN changed_sentence)
+            WHERE id IN (
+                SELECT {table}_id
+                FROM sentence_{table}
+                WHERE sentence_id IN changed_sentence)
+            ''')
+        cursor.execute(
+            f'''
+            DELETE FROM sentence_{table}
+            WHERE sentence_id IN changed_sentence
+            ''')
+    cursor.execute('DELETE FROM review WHERE sentence_id IN changed_sentence')
+    cursor.execute('DELETE FROM sentence WHERE id IN changed_sentence')
+    cursor.execute('DELETE FROM affected_sentence WHERE id IN changed_sentence')
+
+    update_totals(cursor)
+    update_minimum_unknown_frequency(cursor, 'id IN affected_sentence')
+    # The learned trigger only fires when the minimum *becomes* NULL, so new
+    # sentences consisting only of known details need their reviews added here.
+    cursor.execute(
+        f'''
+        INSERT INTO review (sentence_id, type)
+        SELECT id, type
+        FROM sentence, ({' UNION ALL '.join(
+            f"SELECT {review_type.value} AS type" for review_type in ReviewType)})
+        WHERE id > ?
+        AND minimum_unknown_frequency IS NULL
+        ''',
+        (max_id,))
+    (affected,) = next(cursor.execute('SELECT count(*) FROM affected_sentence'))
     conn.commit()
+    print(f'Added {added} sentences, retired {len(retired_ids)}, '
+          f'updated minimum unknown frequency of {affected}')
 
 
 def main(argv):
     parser = argparse.ArgumentParser(
         description='Japanese sentence database')
-    parser.add_argument('command', nargs=1, choices={'build-database'})
+    parser.add_argument('command', nargs=1, choices={'build-database', 'update-database'})
     parser.add_argument('--database', type=str, default='data/new_jpn_sentences.sqlite')
     parser.add_argument('--old-database', type=str, default='data/jpn_sentences.sqlite')
     parser.add_argument('--sentence-table', type=str, default='data/jpn_sentences.csv')
+    parser.add_argument('--stream', action='store_true',
+                        help='read sentences directly from Tatoeba and Aozora '
+                        'instead of the sentence table')
+    parser.add_argument('--tatoeba-database', type=str, default='data/tatoeba.sqlite')
+    parser.add_argument('--tatoeba-language', type=str, default='jpn-Hrkt')
+    parser.add_argument('--minimum-level', type=int, default=5)
+    parser.add_argument('--aozora-files', type=str, default='data/aozora/files')
+    parser.add_argument('--aozora-processes', type=int, default=1,
+                        help='number of processes to extract Aozora works with')
+    parser.add_argument('--extraction-cache', type=str,
+                        default='data/aozora/extraction_cache.sqlite',
+                        help='where to keep extracted Aozora sentences between builds '
+                        '(empty to disable)')
+    parser.add_argument('--kuromoji-workers', type=int, default=1,
+                        help='number of Kuromoji processes to tokenize with')
+    parser.add_argument('--tokenization-cache', type=str, default='data/kuromoji_cache.sqlite',
+                        help='where to keep Kuromoji output between builds (empty to disable)')
+    parser.add_argument('--checkpoint-interval', type=int, default=10000,
+                        help='number of sentences to load between checkpoints')
+    parser.add_argument('--in-memory', action='store_true',
+                        help='aggregate details in memory and insert them in bulk at the end')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='build this many parts of the database in parallel and merge them '
+                        '(implies --in-memory)')
+    build_stats.add_arguments(parser)
     args = parser.parse_args(argv[1:])
 
+    stats.interval = args.progress_interval
     globals()[args.command[0].replace('-', '_')](args)
+    stats.report(args.stats_report)
 
 
 if __name__ == '__main__':
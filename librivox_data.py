@@ -17,17 +17,28 @@
 #   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import concurrent.futures
 import contextlib
 import ffmpeg
 import lxml.etree
 import re
 import requests
+import requests.adapters
 import os
 import os.path
-import tempfile
+import shutil
+import sys
+import threading
+import urllib.parse
+
+import build_stats
+from build_stats import BuildStats
 
 ARCHIVE_URL_PATTERN = re.compile(r'https?://(?:www\.)?archive\.org/(?:compress|download)//?([^/]+)/')
 
+stats = BuildStats('librivox_data')
+
+
 def find_links(args):
     xml_lines = []
     xml_declaration = b'<?xml version="1.0" encoding="utf-8"?>\n'
@@ -46,36 +57,159 @@ def find_links(args):
             print(language, text_source, archive_id, sep='\t')
 
 
+class HostLimitedSession:
+    """
+    A pooled ``requests.Session`` shared by many threads, which lets at most
+    ``per_host`` requests run against the same host at once.
+    """
+
+    def __init__(self, per_host=2, pool_size=16):
+        self.session = requests.Session()
+        # Sizes are checked against Content-Length, so nothing may be decoded.
+        self.session.headers['Accept-Encoding'] = 'identity'
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.per_host = per_host
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def get(self, url, **kwargs):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            semaphore = self.semaphores.setdefault(
+                host, threading.BoundedSemaphore(self.per_host))
+        with semaphore:
+            with self.session.get(url, timeout=60, **kwargs) as response:
+                yield response
+
+
+def download_part(session, uri, part_file, chunk_size=1 << 16):
+    """
+    Downloads ``uri`` to ``part_file``, resuming from a previous partial
+    download in ``part_file + '.part'`` if the server supports ranges, and
+    checking that the size matches what the server announced. Parts that were
+    completed before are skipped.
+    """
+    if os.path.exists(part_file):
+        stats.add('parts skipped')
+        return
+    partial_file = part_file + '.part'
+    try:
+        offset = os.path.getsize(partial_file)
+    except FileNotFoundError:
+        offset = 0
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    with session.get(uri, headers=headers, stream=True) as response:
+        if offset and response.status_code == 416:
+            # Either the previous run got everything, but stopped before
+            # renaming, or the partial file doesn't fit what the server has.
+            unit, _, size = response.headers.get('Content-Range', '').partition(' */')
+            complete = unit.strip() == 'bytes' and size.strip() == str(offset)
+            expected_size = offset
+        else:
+            response.raise_for_status()
+            complete = True
+            if response.status_code == 206:
+                stats.add('parts resumed')
+                expected_size = int(response.headers['Content-Range'].split('/')[-1])
+                mode = 'ab'
+            else:
+                expected_size = response.headers.get('Content-Length')
+                expected_size = expected_size and int(expected_size)
+                mode = 'wb'
+            with open(partial_file, mode) as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    stats.add('bytes', len(chunk))
+    if not complete:
+        os.remove(partial_file)
+        stats.add('parts restarted')
+        return download_part(session, uri, part_file, chunk_size)
+    size = os.path.getsize(partial_file)
+    if expected_size and size != expected_size:
+        # Resuming from a file of the wrong size would only make things worse.
+        os.remove(partial_file)
+        raise IOError(f'{uri}: got {size} bytes instead of {expected_size}')
+    os.replace(partial_file, part_file)
+    stats.add('parts')
+
+
+def concatenate_parts(part_files, output_file):
+    temporary_file = output_file + '.tmp.mp3'
+    ffmpeg.concat(
+        *(ffmpeg.input(part_file).audio for part_file in part_files),
+        v=0,
+        a=1,
+    ).output(temporary_file).overwrite_output().run()
+    os.replace(temporary_file, output_file)
+
+
 def download_audiobooks(args):
+    """
+    Downloads the parts of all audiobooks concurrently and concatenates the
+    parts of each book once they are complete. Parts are kept in a hidden
+    directory until their book is done, so that an interrupted run can pick
+    up where it stopped, and books that are already complete are skipped.
+    """
     with open(args.file_list, 'r') as file_list:
-        os.makedirs(args.output_directory, exist_ok=True)
-        for line in file_list.readlines():
-            line = line.strip()
-            archive_id = line.split('\t')[-1]
-            m3u_link = f'https://archive.org/download/{archive_id}/{archive_id}_64kb.m3u'
+        archive_ids = [line.strip().split('\t')[-1] for line in file_list if line.strip()]
+    os.makedirs(args.output_directory, exist_ok=True)
+    session = HostLimitedSession(args.per_host_connections, args.connections)
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(args.connections) as executor:
+        books = []
+        for archive_id in archive_ids:
             output_file = os.path.join(args.output_directory, archive_id+'.mp3')
-
+            if os.path.exists(output_file):
+                stats.add('books skipped')
+                continue
+            m3u_link = f'{args.base_url}/{archive_id}/{archive_id}_64kb.m3u'
             # Get the list of files. This is nonstandard, not handled by m3u8.
             # Let's hope the format doesn't get upgraded to #EXTM3U later...
-            playlist = requests.get(m3u_link).text.split('\n')
-            parts = []
-            with contextlib.ExitStack() as exit_stack:
-                for uri in playlist:
-                    if uri:
-                        part = exit_stack.enter_context(
-                            tempfile.NamedTemporaryFile(
-                                suffix='.mp3'
-                            )
-                        )
-                        parts.append(part)
-                        # Downloading all at once leads to truncation somehow?
-                        # So download each part to temporary storage first.
-                        ffmpeg.input(uri).output(part.name).overwrite_output().run()
-                ffmpeg.concat(
-                    *(ffmpeg.input(part.name).audio for part in parts),
-                    v=0,
-                    a=1,
-                ).output(output_file).run()
+            try:
+                with session.get(m3u_link) as response:
+                    response.raise_for_status()
+                    playlist = response.text.split('\n')
+            except requests.RequestException as e:
+                failed.append((archive_id, e))
+                continue
+            parts_directory = os.path.join(args.output_directory, '.parts', archive_id)
+            os.makedirs(parts_directory, exist_ok=True)
+            part_files = []
+            futures = []
+            for uri in playlist:
+                uri = uri.strip()
+                if uri:
+                    part_file = os.path.join(parts_directory, f'{len(part_files):04d}.mp3')
+                    part_files.append(part_file)
+                    futures.append(executor.submit(download_part, session, uri, part_file))
+            if not part_files:
+                failed.append((archive_id, 'empty playlist'))
+                continue
+            books.append((archive_id, output_file, parts_directory, part_files, futures))
+
+        for archive_id, output_file, parts_directory, part_files, futures in books:
+            errors = [future.exception() for future in futures if future.exception()]
+            if errors:
+                failed.append((archive_id, errors[0]))
+                continue
+            try:
+                with stats.timer('concatenate'):
+                    concatenate_parts(part_files, output_file)
+            except ffmpeg.Error as e:
+                # The parts are kept, so only the concatenation has to be redone.
+                failed.append((archive_id, e))
+                continue
+            shutil.rmtree(parts_directory)
+            stats.add('books')
+
+    for archive_id, error in failed:
+        print(f'Failed to download {archive_id}: {error}', file=sys.stderr)
+    stats.add('books failed', len(failed))
+    return 1 if failed else 0
 
 
 def main(argv):
@@ -87,11 +221,20 @@ def main(argv):
     parser.add_argument('--index', type=str)
     parser.add_argument('--file-list', type=str)
     parser.add_argument('--output-directory', type=str)
+    parser.add_argument('--base-url', type=str, default='https://archive.org/download',
+                        help='where to fetch the playlists of audiobooks from')
+    parser.add_argument('--connections', type=int, default=8,
+                        help='number of parts to download concurrently')
+    parser.add_argument('--per-host-connections', type=int, default=2,
+                        help='number of concurrent downloads from the same host')
+    build_stats.add_arguments(parser)
     args = parser.parse_args(argv[1:])
 
-    globals()[args.command[0].replace('-', '_')](args)
+    stats.interval = args.progress_interval
+    status = globals()[args.command[0].replace('-', '_')](args)
+    stats.report(args.stats_report)
+    return status
 
 
 if __name__ == '__main__':
-    import sys
-    main(sys.argv)
+    sys.exit(main(sys.argv))
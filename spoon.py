@@ -18,6 +18,7 @@
 
 import argparse
 import datetime
+import functools
 import os
 import math
 import sqlite3
@@ -31,6 +32,7 @@ import PySide2.QtGui as qg
 import PySide2.QtMultimedia as qm
 import PySide2.QtWidgets as qw
 
+from jmdict_data import decompress_gloss
 from jpn_data import ReviewType, JULIANDAY_RELATIVE
 
 #: Let's say forgetting 1 in 20 words is okay.
@@ -189,6 +191,20 @@ def get_sentence_details(cursor, id, only_new=True, translation_languages=['eng'
     return lemmas, grammars, graphemes, forward_pronunciations, backward_pronunciations, sounds
 
 
+def connect_tatoeba(filename):
+    """
+    Opens the Tatoeba database read-only and memory-mapped, so that the compact
+    subset made by ``tatoeba_data.py extract-subset`` is read straight from the
+    page cache.
+    """
+    import pathlib
+
+    path = pathlib.Path(filename).absolute()
+    conn = sqlite3.connect(path.as_uri() + '?mode=ro', uri=True)
+    conn.execute(f'PRAGMA mmap_size = {path.stat().st_size}')
+    return conn
+
+
 def get_translation(tatoeba_cursor, source_id, translation_languages):
     for lang in translation_languages:
         try:
@@ -207,17 +223,26 @@ def get_translation(tatoeba_cursor, source_id, translation_languages):
     return ''
 
 
+@functools.lru_cache(maxsize=None)
+def get_gloss_dictionary(connection):
+    try:
+        (dictionary,), = connection.execute(
+            'SELECT dictionary FROM dictionary.gloss_dictionary')
+    except sqlite3.OperationalError:  # glosses are stored as text
+        return None
+    return dictionary
+
+
 def get_dictionary_gloss(cursor, lemma, disambiguator, translation_languages):
     lemma = lemma.split('-')[0]
+    dictionary = get_gloss_dictionary(cursor.connection)
     glosses = set(
-        gloss
+        decompress_gloss(dictionary, gloss)
         for lang in translation_languages
         for (gloss,) in cursor.execute(
             '''
             SELECT gloss
-            FROM dictionary.disambiguator_to_pos
-                NATURAL JOIN dictionary.entry
-                NATURAL JOIN dictionary.gloss
+            FROM dictionary.lemma_gloss
             WHERE lemma = ?
                 AND disambiguator = ?
                 AND lang = ?
@@ -634,7 +659,7 @@ def recommend_sentence(args):
         ''',
         (id_for_minimum_unknown_frequency,)))
     lemmas, grammars, graphemes, forward_pronunciations, backward_pronunciations, sounds = get_sentence_details(c, id)
-    tatoeba_conn = sqlite3.connect(args.tatoeba_database)
+    tatoeba_conn = connect_tatoeba(args.tatoeba_database)
     tc = tatoeba_conn.cursor()
     translation = get_translation(tc, source_id, args.translation_languages)
     audio_file = get_audio(tc, text.replace('\t', ''), source_id)
@@ -677,6 +702,8 @@ def review(args):
             f'Could not find the dictionary at {args.dictionary_database}',
             file=sys.stderr)
         sys.exit(1)
+    tatoeba_conn = connect_tatoeba(args.tatoeba_database)
+    tc = tatoeba_conn.cursor()
     app = qw.QApplication()
 
     def generate_reviews():
@@ -692,8 +719,6 @@ def review(args):
                            for table, kind
                            in ReviewType(review_type).tables_kinds):
                     locals()[table_kind].clear()
-            tatoeba_conn = sqlite3.connect(args.tatoeba_database)
-            tc = tatoeba_conn.cursor()
             translation = get_translation(tc, source_id, args.translation_languages)
             audio_file = get_audio(tc, text.replace('\t', ''), source_id)
 
@@ -17,215 +17,501 @@
 #   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
 
 import argparse
+import contextlib
+import os
+import re
 import sqlite3
 
+import build_stats
+from build_stats import BuildStats, set_bulk_load_pragmas
+
+
+stats = BuildStats('tatoeba_data')
+
+
+@contextlib.contextmanager
+def open_export(filename):
+    """
+    Opens a Tatoeba export as text, whether it is a plain file, a bzip2-compressed
+    TSV file or a bzip2-compressed tarball containing one. Decompression happens
+    in a separate process (using lbzip2 or pbzip2 if available, which use several
+    cores), so that it overlaps with parsing.
+    """
+    import io
+    import shutil
+    import subprocess
+
+    if not filename.endswith('.bz2'):
+        with open(filename, newline='\n') as file:
+            yield file
+        return
+    bzip2 = next(filter(shutil.which, ('lbzip2', 'pbzip2')), 'bzip2')
+    if filename.endswith('.tar.bz2'):
+        command = ['tar', '--extract', '--to-stdout',
+                   f'--use-compress-program={bzip2}', f'--file={filename}']
+    else:
+        command = [bzip2, '--decompress', '--stdout', filename]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    try:
+        yield io.TextIOWrapper(process.stdout, encoding='utf-8', newline='\n')
+        if process.wait():
+            raise RuntimeError(f'{command[0]} failed to decompress {filename}')
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+
 
 def read_escaped_lines(filename):
-    with open(filename, newline='\n') as file:
-        continued_line = ''
+    with open_export(filename) as file:
+        continued_line = []
         for line in file:
             if line.endswith('\\\n'):
                 backslash_count = len(line) - len(line.rstrip('\n').rstrip('\\')) - 1
                 if backslash_count % 2:
-                    continued_line += line[:-2]+'\n'
+                    continued_line.append(line[:-2]+'\n')
                     continue
-            continued_line += line[:-1]
-            yield continued_line
-            continued_line = ''
+            if continued_line:
+                continued_line.append(line[:-1])
+                yield ''.join(continued_line)
+                continued_line = []
+            else:
+                yield line[:-1]
         if continued_line:
-            yield continued_line
+            yield ''.join(continued_line)
+
+
+TSV_ESCAPE_PATTERN = re.compile(r'\\(.?)|\t', re.DOTALL)
 
 
 def split_tsv_line(line):
+    """
+    Splits a line of a Tatoeba export into fields. A backslash escapes a tab
+    or another backslash and is kept before any other character, and a field
+    reading \\N after unescaping is NULL.
+    """
+    if '\\' not in line:
+        # Without backslashes there is nothing to unescape and no field can be NULL.
+        return line.split('\t')
     splits = []
-    current_split = ''
-    escaped = False
-    for char in line:
-        if escaped:
-            if char not in {'\\', '\t'}:
-                current_split += '\\'
-            current_split += char
-            escaped = False
-        elif char == '\\':
-            escaped = True
-        elif char == '\t':
-            if current_split == '\\N':
-                current_split = None
-            splits.append(current_split)
-            current_split = ''
+    current_split = []
+    position = 0
+    for match in TSV_ESCAPE_PATTERN.finditer(line):
+        current_split.append(line[position:match.start()])
+        position = match.end()
+        escaped = match.group(1)
+        if escaped is None:
+            current_split = ''.join(current_split)
+            splits.append(None if current_split == '\\N' else current_split)
+            current_split = []
+        elif escaped in {'\\', '\t', ''}:
+            # A backslash at the very end of the line is dropped.
+            current_split.append(escaped)
         else:
-            current_split += char
-    if current_split == '\\N':
-        current_split = None
-    splits.append(current_split)
+            current_split.append('\\'+escaped)
+    current_split.append(line[position:])
+    current_split = ''.join(current_split)
+    splits.append(None if current_split == '\\N' else current_split)
     return splits
 
 
 def read_tatoeba_tsv(filename):
-    for line in read_escaped_lines(filename):
-        yield split_tsv_line(line)
-
-
-def read_user_languages():
+    name = os.path.basename(filename)
+    return stats.timed(
+        f'parse {name}',
+        map(split_tsv_line, read_escaped_lines(filename)),
+        f'{name} rows')
+
+
+def export_filename(name):
+    """
+    Exports are read straight from the archives Tatoeba publishes, preferring
+    the newest if there are several. An extracted CSV file is only used if
+    there is no archive.
+    """
+    archives = [
+        filename
+        for filename in (f'data/tatoeba/{name}.tar.bz2', f'data/tatoeba/{name}.tsv.bz2')
+        if os.path.exists(filename)]
+    if archives:
+        return max(archives, key=os.path.getmtime)
+    return f'data/tatoeba/{name}.csv'
+
+
+def user_language_rows():
+    for user_list in (
+            export_filename('user_languages'),
+            'CKs_native_speaker_list.csv'):
+        for lang, level, user, details in read_tatoeba_tsv(user_list):
+            if lang and user:
+                yield lang, level, user, details
+
+
+def export_rows(name):
+    return read_tatoeba_tsv(export_filename(name))
+
+
+# Indexes for filtered_sentences. update_database also adds them to older databases.
+FILTER_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_level_language_users ON user_languages(lang, level, user)',
+    'CREATE INDEX IF NOT EXISTS idx_language_sentences ON sentences_detailed(lang)',
+    'CREATE INDEX IF NOT EXISTS idx_name_tags ON tags(name, id)',
+)
+
+
+# (table, schema, indexes, insert statement, rows function, its arguments)
+TABLES = (
+    ('user_languages',
+     '''
+     CREATE TABLE IF NOT EXISTS user_languages (
+         lang text,
+         level integer,
+         user text,
+         details text,
+         PRIMARY KEY (lang, user))
+     ''',
+     ('CREATE INDEX idx_language_users ON user_languages(lang)', FILTER_INDEXES[0]),
+     'INSERT OR IGNORE INTO user_languages VALUES (?,?,?,?)',
+     user_language_rows, ()),
+    ('sentences_detailed',
+     '''
+     CREATE TABLE IF NOT EXISTS sentences_detailed (
+         id integer PRIMARY KEY,
+         lang text,
+         text text,
+         user text,
+         added date,
+         modified date)
+     ''',
+     ('CREATE INDEX idx_user_sentences ON sentences_detailed(user)', FILTER_INDEXES[1]),
+     'INSERT INTO sentences_detailed VALUES (?,?,?,?,?,?)',
+     export_rows, ('sentences_detailed',)),
+    ('links',
+     '''
+     CREATE TABLE IF NOT EXISTS links (
+         sentence_id integer REFERENCES sentences_detailed(id),
+         translation_id integer REFERENCES sentences_detailed(id))
+     ''',
+     ('CREATE INDEX idx_links_sentence ON links(sentence_id)',),
+     'INSERT INTO links VALUES (?,?)',
+     export_rows, ('links',)),
+    ('tags',
+     '''
+     CREATE TABLE IF NOT EXISTS tags (
+         id integer REFERENCES sentences_detailed(id),
+         name text)
+     ''',
+     (FILTER_INDEXES[2],),
+     'INSERT INTO tags VALUES (?,?)',
+     export_rows, ('tags',)),
+    ('sentences_with_audio',
+     '''
+     CREATE TABLE IF NOT EXISTS sentences_with_audio (
+         sentence_id integer REFERENCES sentences_detailed(id),
+         audio_id integer PRIMARY KEY,
+         user text REFERENCES sentences_detailed(user),
+         license text,
+         attribution text)
+     ''',
+     ('CREATE INDEX idx_sentences_with_audio_sentence ON sentences_with_audio(sentence_id)',),
+     'INSERT OR REPLACE INTO sentences_with_audio VALUES (?,?,?,?,?)',
+     export_rows, ('sentences_with_audio',)),
+    ('transcriptions',
+     '''
+     CREATE TABLE IF NOT EXISTS transcriptions (
+         id integer REFERENCES sentences_detailed(id),
+         lang text REFERENCES sentences_detailed(lang),
+         script text,
+         user text REFERENCES sentences_detailed(user),
+         transcription text,
+         PRIMARY KEY (id, script))
+     ''',
+     (),
+     'INSERT OR REPLACE INTO transcriptions VALUES (?,?,?,?,?)',
+     export_rows, ('transcriptions',)),
+)
+
+
+def read_table(conn, table, schema, indexes, insert, rows, rows_args):
     c = conn.cursor()
-    c.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS user_languages (
-            lang text,
-            level integer,
-            user text,
-            details text,
-            PRIMARY KEY (lang, user))
-        ''')
-    c.execute(
-        '''
-        CREATE INDEX idx_language_users ON user_languages(lang)
-        ''')
-    c.executemany('INSERT OR IGNORE INTO user_languages VALUES (?,?,?,?)',
-                  ((lang, level, user, details)
-                   for user_list in (
-                           'data/tatoeba/user_languages.csv',
-                           'CKs_native_speaker_list.csv')
-                   for lang, level, user, details
-                   in read_tatoeba_tsv(user_list)
-                   if lang and user))
-    conn.commit()
-
-
-def read_sentences():
+    c.execute(schema)
+    for index in indexes:
+        c.execute(index)
+    with stats.timer(f'load {table}'):
+        c.executemany(insert, rows(*rows_args))
+        conn.commit()
+
+
+def produce_rows(queue, table, rows, rows_args, batch_size=1024):
+    """
+    Parses the input of one table in a separate process, handing its rows over
+    in batches through a queue, followed by the statistics of the process.
+    """
+    import traceback
+
+    global stats
+    stats = BuildStats(f'tatoeba_data {table}', stats.interval)
+    try:
+        batch = []
+        for row in rows(*rows_args):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                queue.put((table, batch))
+                batch = []
+        queue.put((table, batch))
+        queue.put((table, stats.as_dict()))
+    except BaseException:
+        queue.put((table, traceback.format_exc()))
+
+
+def parse_in_parallel(queue_size=64):
+    """
+    Parses all exports concurrently in their own processes and yields
+    ``(table, batch)`` pairs in whatever order the batches become ready.
+    """
+    import multiprocessing
+
+    queue = multiprocessing.Queue(queue_size)
+    processes = [
+        multiprocessing.Process(
+            target=produce_rows, args=(queue, table, rows, rows_args), daemon=True)
+        for table, schema, indexes, insert, rows, rows_args in TABLES]
+    for process in processes:
+        process.start()
+    try:
+        remaining = len(TABLES)
+        while remaining:
+            table, batch = queue.get()
+            if isinstance(batch, list):
+                yield table, batch
+            elif isinstance(batch, dict):
+                stats.merge(batch)
+                remaining -= 1
+            else:
+                raise RuntimeError(f'Reading {table} failed:\n{batch}')
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+
+def bulk_load(database):
+    """
+    Parses all exports in parallel, while a single writer inserts the rows
+    without journaling and creates the indexes only once all tables are
+    filled. The database is built under a temporary name, so an interrupted
+    build leaves nothing behind that looks complete.
+    """
+    temporary = database + '.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    conn = sqlite3.connect(temporary)
     c = conn.cursor()
-    c.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS sentences_detailed (
-            id integer PRIMARY KEY,
-            lang text,
-            text text,
-            user text,
-            added date,
-            modified date)
-        ''')
-    c.execute(
-        '''
-        CREATE INDEX idx_user_sentences ON sentences_detailed(user)
-        ''')
-    c.executemany('INSERT INTO sentences_detailed VALUES (?,?,?,?,?,?)',
-                  read_tatoeba_tsv('data/tatoeba/sentences_detailed.csv'))
+    set_bulk_load_pragmas(c)
+    inserts = {}
+    for table, schema, indexes, insert, rows, rows_args in TABLES:
+        c.execute(schema)
+        inserts[table] = insert
+    for table, batch in parse_in_parallel():
+        with stats.timer(f'load {table}'):
+            c.executemany(inserts[table], batch)
+    for table, schema, indexes, insert, rows, rows_args in TABLES:
+        with stats.timer(f'index {table}'):
+            for index in indexes:
+                c.execute(index)
     conn.commit()
+    conn.close()
+    os.replace(temporary, database)
 
 
-def read_links():
-    c = conn.cursor()
+def build_database(args):
+    try:
+        os.remove(args.database)
+    except FileNotFoundError:
+        pass
+    if args.bulk_load:
+        bulk_load(args.database)
+        return
+    conn = sqlite3.connect(args.database)
+    for table in TABLES:
+        read_table(conn, *table)
+
+
+# Columns identifying a row when diffing exports. Where they are all the columns,
+# a changed row is simply a removed one plus an added one; Tatoeba doesn't
+# repeat links or tags, so those tables are compared as sets.
+TABLE_KEYS = {
+    'user_languages': ('lang', 'user'),
+    'sentences_detailed': ('id',),
+    'links': ('sentence_id', 'translation_id'),
+    'tags': ('id', 'name'),
+    'sentences_with_audio': ('audio_id',),
+    'transcriptions': ('id', 'script'),
+}
+
+
+def diff_table(c, table):
+    """
+    Compares ``table`` with the new export staged in ``temp.new_{table}``,
+    collecting rows that are new or differ (e.g. in their ``modified`` date)
+    in ``temp.changed_{table}`` and rows that are gone in
+    ``temp.removed_{table}``, each with the rowid of the old row.
+    """
+    keys = TABLE_KEYS[table]
+    columns = [column for cid, column, *_ in c.execute(f'PRAGMA main.table_info({table})')]
+    if set(keys) == set(columns):
+        c.execute(f'CREATE INDEX temp.new_{table}_key ON new_{table} ({", ".join(keys)})')
+    join = ' AND '.join(f'o.{key} IS n.{key}' for key in keys)
+    differs = ' OR '.join(f'o.{column} IS NOT n.{column}' for column in columns)
     c.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS links (
-            sentence_id integer REFERENCES sentences_detailed(id),
-            translation_id integer REFERENCES sentences_detailed(id))
+        f'''
+        CREATE TEMPORARY TABLE changed_{table} AS
+        SELECT o.rowid AS old_rowid, n.*
+        FROM temp.new_{table} AS n
+        LEFT JOIN main.{table} AS o ON {join}
+        WHERE o.rowid IS NULL OR {differs}
         ''')
     c.execute(
-        '''
-        CREATE INDEX idx_links_sentence ON links(sentence_id)
+        f'''
+        CREATE TEMPORARY TABLE removed_{table} AS
+        SELECT o.rowid AS old_rowid, o.*
+        FROM main.{table} AS o
+        LEFT JOIN temp.new_{table} AS n ON {join}
+        WHERE n.rowid IS NULL
         ''')
-    c.executemany('INSERT INTO links VALUES (?,?)',
-                  read_tatoeba_tsv('data/tatoeba/links.csv'))
-    conn.commit()
-
-
-def read_tags():
-    c = conn.cursor()
-    c.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS tags (
-            id integer REFERENCES sentences_detailed(id),
-            name text)
-        ''')
-    c.executemany('INSERT INTO tags VALUES (?,?)',
-                  read_tatoeba_tsv('data/tatoeba/tags.csv'))
-    conn.commit()
-
-
-def read_sentences_with_audio():
-    c = conn.cursor()
+    return next(c.execute(
+        f'''
+        SELECT
+            (SELECT count(*) FROM changed_{table} WHERE old_rowid IS NULL),
+            (SELECT count(*) FROM changed_{table} WHERE old_rowid IS NOT NULL),
+            (SELECT count(*) FROM removed_{table})
+        '''))
+
+
+def record_changed_sentences(c):
+    """
+    Fills ``changed_sentences`` with the sentences whose text, metadata, tags or
+    transcriptions changed, or whose author changed their language level, so
+    that derived databases only need to look at those. Both the old and the new
+    language of a sentence are recorded.
+    """
+    c.execute('DROP TABLE IF EXISTS changed_sentences')
     c.execute(
         '''
-        CREATE TABLE IF NOT EXISTS sentences_with_audio (
-            sentence_id integer REFERENCES sentences_detailed(id),
-            audio_id integer PRIMARY KEY,
-            user text REFERENCES sentences_detailed(user),
-            license text,
-            attribution text)
+        CREATE TABLE changed_sentences (
+            id integer,
+            lang text,
+            PRIMARY KEY (id, lang))
         ''')
     c.execute(
         '''
-        CREATE INDEX idx_sentences_with_audio_sentence ON sentences_with_audio(sentence_id)
+        INSERT OR IGNORE INTO changed_sentences
+        SELECT id, lang FROM changed_sentences_detailed
+        UNION ALL
+        SELECT id, lang FROM removed_sentences_detailed
+        UNION ALL
+        SELECT id, lang FROM main.sentences_detailed
+        WHERE rowid IN (SELECT old_rowid FROM changed_sentences_detailed)
+        UNION ALL
+        SELECT id, lang FROM main.sentences_detailed
+        WHERE id IN (
+            SELECT id FROM changed_tags
+            UNION SELECT id FROM removed_tags
+            UNION SELECT id FROM changed_transcriptions
+            UNION SELECT id FROM removed_transcriptions)
+        UNION ALL
+        SELECT s.id, s.lang
+        FROM (
+            SELECT lang, user FROM changed_user_languages
+            UNION SELECT lang, user FROM removed_user_languages
+        ) AS u
+        JOIN main.sentences_detailed AS s ON s.user = u.user AND s.lang = u.lang
         ''')
-    c.executemany('INSERT OR REPLACE INTO sentences_with_audio VALUES (?,?,?,?,?)',
-                  read_tatoeba_tsv('data/tatoeba/sentences_with_audio.csv'))
-    conn.commit()
 
 
-def read_transcriptions():
+def update_database(args):
+    """
+    Brings an existing database up to date with a new export. The new export is
+    parsed into temporary tables and only rows which were added, changed or
+    removed are written, in a single transaction. The affected sentences are
+    listed in ``changed_sentences``.
+    """
+    conn = sqlite3.connect(args.database)
     c = conn.cursor()
-    c.execute(
-        '''
-        CREATE TABLE IF NOT EXISTS transcriptions (
-            id integer REFERENCES sentences_detailed(id),
-            lang text REFERENCES sentences_detailed(lang),
-            script text,
-            user text REFERENCES sentences_detailed(user),
-            transcription text,
-            PRIMARY KEY (id, script))
-        ''')
-    c.executemany('INSERT OR REPLACE INTO transcriptions VALUES (?,?,?,?,?)',
-                  read_tatoeba_tsv('data/tatoeba/transcriptions.csv'))
+    c.execute('PRAGMA cache_size = -1048576')  # 1 GiB
+    for index in FILTER_INDEXES:
+        c.execute(index)
+    inserts = {}
+    for table, schema, indexes, insert, rows, rows_args in TABLES:
+        staging_schema = schema.replace(
+            f'EXISTS {table} (', f'EXISTS temp.new_{table} (')
+        staging_insert = insert.replace(
+            f'INTO {table} VALUES', f'INTO temp.new_{table} VALUES')
+        assert staging_schema != schema and staging_insert != insert
+        c.execute(staging_schema)
+        inserts[table] = staging_insert
+    for table, batch in parse_in_parallel():
+        with stats.timer(f'stage {table}'):
+            c.executemany(inserts[table], batch)
+
+    changes = {}
+    for table in TABLE_KEYS:
+        with stats.timer(f'diff {table}'):
+            changes[table] = diff_table(c, table)
+    with stats.timer('record changed sentences'):
+        record_changed_sentences(c)
+    for table in TABLE_KEYS:
+        with stats.timer(f'apply {table}'):
+            c.execute(
+                f'''
+                DELETE FROM main.{table}
+                WHERE rowid IN (
+                    SELECT old_rowid FROM removed_{table}
+                    UNION ALL
+                    SELECT old_rowid FROM changed_{table})
+                ''')
+            c.execute(
+                f'''
+                INSERT INTO main.{table}
+                SELECT {', '.join(
+                    column for cid, column, *_
+                    in c.execute(f'PRAGMA main.table_info({table})').fetchall())}
+                FROM changed_{table}
+                ''')
+    (changed_sentences,) = next(c.execute('SELECT count(DISTINCT id) FROM changed_sentences'))
     conn.commit()
+    for table, (inserted, updated, deleted) in changes.items():
+        print(f'{table}: {inserted} inserted, {updated} updated, {deleted} deleted')
+    print(f'{changed_sentences} sentences changed')
 
 
-def build_database(args):
-    from os import remove
-    try:
-        remove(args.database)
-    except FileNotFoundError:
-        pass
-    global conn
-    conn = sqlite3.connect(args.database)
-    read_user_languages()
-    read_sentences()
-    read_links()
-    read_tags()
-    read_sentences_with_audio()
-    read_transcriptions()
-
-
-def filter_language(args):
-    lang_tags = args.language.split('-')
+def filtered_sentences(database, language, minimum_level):
+    lang_tags = language.split('-')
     lang = lang_tags[0]
     if len(lang_tags) == 2:
         script = lang_tags[1]
     else:
         script = ''
-    global conn
-    conn = sqlite3.connect(args.database)
+    conn = sqlite3.connect(database)
     c = conn.cursor()
+    # Transcriptions are looked up by primary key, the tagged sentences and
+    # qualified users come from covering indexes and are only computed once.
     for row in c.execute(
             '''
             SELECT
                 s.id,
                 s.lang,
-                IFNULL(
-                    (
-                        SELECT t.transcription
-                        FROM transcriptions AS t
-                        WHERE t.id = s.id
-                        AND script = :script
-                        AND user != ''
-                    ),
-                    s.text
-                ),
+                IFNULL(t.transcription, s.text),
                 s.user,
                 s.added,
                 s.modified
             FROM
                 sentences_detailed AS s
+                LEFT JOIN transcriptions AS t
+                ON t.id = s.id
+                AND t.script = :script
+                AND t.user != ''
             WHERE
                 s.lang = :lang
                 AND (
@@ -236,15 +522,100 @@ def filter_language(args):
                             FROM user_languages
                             WHERE lang = :lang
                             AND level >= :level)))
+            ORDER BY s.id
             ''',
             dict(
                 lang=lang,
                 script=script,
-                level=args.minimum_level)):
+                level=minimum_level)):
         id, lang, text, user, added, modified = row
         url = 'https://tatoeba.org/eng/sentences/show/'+str(id)
         license = 'https://creativecommons.org/licenses/by/2.0/'
-        print('\t'.join(('tatoeba', url, str(id), license, user or 'unknown user', text)))
+        yield ('tatoeba', url, str(id), license, user or 'unknown user', text)
+
+
+def filter_language(args):
+    import sys
+
+    for row in filtered_sentences(args.database, args.language, args.minimum_level):
+        sys.stdout.write('\t'.join(row) + '\n')
+        stats.add('filtered sentences')
+
+
+# Tables needed by spoon.py, with the indexes that get_translation and get_audio use.
+SUBSET_INDEXES = {
+    'sentences_detailed': (),
+    'links': ('CREATE INDEX idx_links_sentence ON links(sentence_id)',),
+    'sentences_with_audio': (
+        'CREATE INDEX idx_sentences_with_audio_sentence ON sentences_with_audio(sentence_id)',),
+}
+
+
+def extract_subset(args):
+    """
+    Copies what spoon.py needs at review time into a compact database: links
+    from sentences in ``--language`` to their translations in
+    ``--translation-languages``, those translations and the recordings of the
+    sentences. Tables are the same as in the full database and rows keep their
+    order, so queries give the same results, but only the pages for one
+    language pair need to be read. The database is written in one go and
+    never modified, so it can be opened read-only and memory-mapped.
+    """
+    placeholders = ', '.join('?' for lang in args.translation_languages)
+    temporary = args.subset_database + '.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    conn = sqlite3.connect(temporary)
+    c = conn.cursor()
+    set_bulk_load_pragmas(c)
+    c.execute('ATTACH DATABASE ? AS full', (args.database,))
+    for table, schema, indexes, insert, rows, rows_args in TABLES:
+        if table in SUBSET_INDEXES:
+            c.execute(schema)
+    with stats.timer('extract links'):
+        c.execute(
+            f'''
+            INSERT INTO links
+            SELECT l.sentence_id, l.translation_id
+            FROM full.sentences_detailed AS s
+            JOIN full.links AS l ON l.sentence_id = s.id
+            JOIN full.sentences_detailed AS t ON t.id = l.translation_id
+            WHERE s.lang = ?
+            AND t.lang IN ({placeholders})
+            ORDER BY l.rowid
+            ''',
+            (args.language, *args.translation_languages))
+    with stats.timer('extract sentences'):
+        c.execute(
+            '''
+            INSERT INTO sentences_detailed
+            SELECT *
+            FROM full.sentences_detailed
+            WHERE id IN (SELECT translation_id FROM links)
+            ORDER BY id
+            ''')
+    with stats.timer('extract audio'):
+        c.execute(
+            '''
+            INSERT INTO sentences_with_audio
+            SELECT a.*
+            FROM full.sentences_with_audio AS a
+            JOIN full.sentences_detailed AS s ON s.id = a.sentence_id
+            WHERE s.lang = ?
+            ORDER BY a.audio_id
+            ''',
+            (args.language,))
+    for table, indexes in SUBSET_INDEXES.items():
+        with stats.timer(f'index {table}'):
+            for index in indexes:
+                c.execute(index)
+    conn.commit()
+    c.execute('DETACH DATABASE full')
+    for table in SUBSET_INDEXES:
+        (count,) = next(c.execute(f'SELECT count(*) FROM {table}'))
+        stats.add(f'{table} rows', count)
+    conn.close()
+    os.replace(temporary, args.subset_database)
 
 
 def main(argv):
@@ -252,13 +623,23 @@ def main(argv):
         description='Tatoeba data file parser')
     parser.add_argument('command', nargs=1, choices={
         'build-database',
+        'update-database',
+        'extract-subset',
         'filter-language'})
     parser.add_argument('--database', type=str, default='data/tatoeba.sqlite')
     parser.add_argument('--minimum-level', type=int, default=5)
     parser.add_argument('--language', type=str)
+    parser.add_argument('--translation-languages', type=str, nargs='+', default=['eng'])
+    parser.add_argument('--subset-database', type=str, default='data/tatoeba_jpn.sqlite')
+    parser.add_argument('--bulk-load', action='store_true',
+                        help='parse all exports in parallel, write without journaling '
+                        'and create indexes at the end')
+    build_stats.add_arguments(parser)
     args = parser.parse_args(argv[1:])
 
+    stats.interval = args.progress_interval
     globals()[args.command[0].replace('-', '_')](args)
+    stats.report(args.stats_report)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+
+#   Alphabet Soup gives language learners easily digestible chunks for practice.
+#   Copyright 2019-2020 Yorwba
+
+#   Alphabet Soup is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU Affero General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+
+#   Alphabet Soup is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import io
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+import jpn_data
+
+
+# Stands in for Kuromoji: one token per character, dropping spaces, so that
+# the stored text of a sentence with spaces differs from its input. Given a
+# filename, it exits at the first sentence with a ！ unless that file exists,
+# which it creates, so that a build fails once.
+FAKE_KUROMOJI = '''
+import os
+import sys
+crash_once = sys.argv[1] if len(sys.argv) > 1 else None
+for line in sys.stdin:
+    if crash_once and '！' in line and not os.path.exists(crash_once):
+        open(crash_once, 'w').close()
+        sys.exit(1)
+    for char in line.rstrip('\\n'):
+        if not char.isspace():
+            print(f'{char}\\t名詞,普通名詞,一般,*,*,*,{char},{char}')
+    print('EOS')
+    sys.stdout.flush()
+'''
+
+
+class JpnDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        fake_kuromoji = self.path('kuromoji.py')
+        with open(fake_kuromoji, 'w') as f:
+            f.write(FAKE_KUROMOJI)
+        kuromoji_command = jpn_data.KUROMOJI_COMMAND
+        jpn_data.KUROMOJI_COMMAND = self.kuromoji_command = [sys.executable, fake_kuromoji]
+        self.addCleanup(setattr, jpn_data, 'KUROMOJI_COMMAND', kuromoji_command)
+
+    def path(self, name):
+        return os.path.join(self.directory.name, name)
+
+    def write_sentence_table(self, sentences):
+        sentence_table = self.path('sentences.csv')
+        with open(sentence_table, 'w') as f:
+            for i, sentence in enumerate(sentences):
+                print('\t'.join(('tatoeba', f'u{i}', str(i), 'lic', 'me', sentence)), file=f)
+        return sentence_table
+
+    def run_jpn_data(self, command, database, sentence_table, *options):
+        with contextlib.redirect_stdout(io.StringIO()):
+            jpn_data.main([
+                'jpn_data.py', command,
+                f'--database={database}',
+                f'--sentence-table={sentence_table}',
+                '--old-database=',
+                '--tokenization-cache=',
+                f'--stats-report={os.devnull}',
+                *options])
+
+    def contents(self, database):
+        conn = sqlite3.connect(database)
+        contents = {
+            'sentence': sorted(conn.execute('SELECT text FROM sentence')),
+            'totals': list(conn.execute('SELECT * FROM totals')),
+        }
+        for table, fields in jpn_data.DETAIL_TABLES:
+            contents[table] = sorted(conn.execute(
+                f'SELECT {", ".join(fields)}, frequency FROM {table}'))
+            contents[f'sentence_{table}'] = sorted(conn.execute(
+                f'''
+                SELECT s.text, {", ".join(f"d.{field}" for field in fields)}
+                FROM sentence_{table} AS l, sentence AS s, {table} AS d
+                WHERE l.sentence_id = s.id AND l.{table}_id = d.id
+                '''))
+        conn.close()
+        return contents
+
+    def test_build_modes_agree(self):
+        sentence_table = self.write_sentence_table(['犬 お', 'かあ', '犬お', 'お 犬', '犬お'])
+        databases = {}
+        for name, options in [
+                ('per-row', ()),
+                ('in-memory', ('--in-memory',)),
+                ('sharded', ('--shards=2',))]:
+            database = self.path(f'{name}.sqlite')
+            self.run_jpn_data('build-database', database, sentence_table, *options)
+            databases[name] = self.contents(database)
+        self.assertEqual(databases['per-row']['sentence'], [('お犬',), ('かあ',), ('犬お',)])
+        self.assertEqual(databases['per-row'], databases['in-memory'])
+        self.assertEqual(databases['per-row'], databases['sharded'])
+
+    def test_resumed_build_agrees(self):
+        sentence_table = self.write_sentence_table(['犬お', 'かあ', '！', '犬 お', 'かあ'])
+        database = self.path('resumed.sqlite')
+        jpn_data.KUROMOJI_COMMAND = self.kuromoji_command + [self.path('crashed')]
+        with contextlib.redirect_stderr(io.StringIO()):
+            with self.assertRaises(RuntimeError):
+                self.run_jpn_data(
+                    'build-database', database, sentence_table, '--checkpoint-interval=1')
+            self.assertTrue(os.path.exists(database + '.progress'))
+            self.run_jpn_data(
+                'build-database', database, sentence_table, '--checkpoint-interval=1')
+        expected_database = self.path('expected.sqlite')
+        self.run_jpn_data('build-database', expected_database, sentence_table, '--in-memory')
+        self.assertEqual(self.contents(database), self.contents(expected_database))
+
+    def test_tokenization_cache(self):
+        items = [(str(i), f'犬{i % 7}お{i}') for i in range(50)]
+        with jpn_data.Kuromoji(2) as kuromoji:
+            expected = list(kuromoji.tokenize(items))
+        cache_filename = self.path('cache.sqlite')
+        for end in (30, 50, 50):
+            # Small chunks, so that misses continue across chunk boundaries.
+            with jpn_data.Kuromoji(2) as kuromoji, \
+                    jpn_data.TokenizationCache(cache_filename) as cache:
+                self.assertEqual(
+                    list(cache.tokenize(kuromoji, items[:end], chunk_size=3)),
+                    expected[:end])
+        # Everything was cached, so Kuromoji wasn't even started.
+        self.assertEqual(kuromoji.processes, [])
+
+    def test_repeated_update_is_a_no_op(self):
+        sentence_table = self.write_sentence_table(['犬 お', 'かあ', '犬お'])
+        database = self.path('jpn.sqlite')
+        self.run_jpn_data('build-database', database, sentence_table)
+        built = self.contents(database)
+        self.assertEqual(built['sentence'], [('かあ',), ('犬お',)])
+        for _ in range(2):
+            self.run_jpn_data('update-database', database, sentence_table)
+            self.assertEqual(self.contents(database), built)
+
+    def test_update_adds_and_retires(self):
+        database = self.path('jpn.sqlite')
+        self.run_jpn_data(
+            'build-database', database, self.write_sentence_table(['犬 お', 'かあ']))
+        sentence_table = self.write_sentence_table(['犬 お', 'あか'])
+        self.run_jpn_data('update-database', database, sentence_table)
+        updated = self.contents(database)
+        rebuilt_database = self.path('rebuilt.sqlite')
+        self.run_jpn_data('build-database', rebuilt_database, sentence_table)
+        self.assertEqual(updated, self.contents(rebuilt_database))
+
+
+if __name__ == '__main__':
+    unittest.main()
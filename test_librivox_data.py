@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+#   Alphabet Soup gives language learners easily digestible chunks for practice.
+#   Copyright 2019-2020 Yorwba
+
+#   Alphabet Soup is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU Affero General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+
+#   Alphabet Soup is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import contextlib
+import http.server
+import io
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+import librivox_data
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves ``server.files`` with support for ranges, like archive.org does.
+    Paths in ``server.oversized`` announce a total size one byte larger than
+    what they actually send.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.files.get(self.path)
+        requested_range = self.headers.get('Range')
+        self.server.requests.append((self.path, requested_range))
+        if data is None:
+            self.send_body(404, b'')
+            return
+        if not requested_range:
+            self.send_body(200, data)
+            return
+        start = int(requested_range.split('=')[1].rstrip('-'))
+        total = len(data) + (self.path in self.server.oversized)
+        if start >= total:
+            self.send_body(416, b'', {'Content-Range': f'bytes */{total}'})
+            return
+        self.send_body(
+            206, data[start:], {'Content-Range': f'bytes {start}-{total - 1}/{total}'})
+
+    def send_body(self, status, body, headers={}):
+        self.send_response(status)
+        for header, value in headers.items():
+            self.send_header(header, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class DownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.files = {}
+        self.server.oversized = set()
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        self.session = librivox_data.HostLimitedSession()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def serve(self, path, data):
+        self.server.files[path] = data
+        return self.base_url + path
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            return f.read()
+
+    def write(self, filename, data):
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    def test_download(self):
+        data = os.urandom(100000)
+        part_file = self.path('0000.mp3')
+        librivox_data.download_part(self.session, self.serve('/a.mp3', data), part_file)
+        self.assertEqual(self.read(part_file), data)
+        self.assertFalse(os.path.exists(part_file + '.part'))
+
+    def test_resume(self):
+        data = os.urandom(100000)
+        part_file = self.path('0000.mp3')
+        self.write(part_file + '.part', data[:30000])
+        librivox_data.download_part(self.session, self.serve('/a.mp3', data), part_file)
+        self.assertEqual(self.read(part_file), data)
+        self.assertEqual(self.server.requests, [('/a.mp3', 'bytes=30000-')])
+
+    def test_complete_partial_file(self):
+        data = os.urandom(1000)
+        part_file = self.path('0000.mp3')
+        self.write(part_file + '.part', data)
+        librivox_data.download_part(self.session, self.serve('/a.mp3', data), part_file)
+        self.assertEqual(self.read(part_file), data)
+        self.assertEqual(self.server.requests, [('/a.mp3', 'bytes=1000-')])
+
+    def test_partial_file_larger_than_served(self):
+        data = os.urandom(1000)
+        part_file = self.path('0000.mp3')
+        self.write(part_file + '.part', os.urandom(1500))
+        librivox_data.download_part(self.session, self.serve('/a.mp3', data), part_file)
+        self.assertEqual(self.read(part_file), data)
+        self.assertEqual(
+            self.server.requests, [('/a.mp3', 'bytes=1500-'), ('/a.mp3', None)])
+
+    def test_size_mismatch(self):
+        data = os.urandom(1000)
+        part_file = self.path('0000.mp3')
+        self.write(part_file + '.part', data[:500])
+        uri = self.serve('/a.mp3', data)
+        self.server.oversized.add('/a.mp3')
+        with self.assertRaises(IOError):
+            librivox_data.download_part(self.session, uri, part_file)
+        self.assertFalse(os.path.exists(part_file))
+        self.assertFalse(os.path.exists(part_file + '.part'))
+
+    def download_audiobooks(self, archive_ids):
+        file_list = self.path('list.tsv')
+        with open(file_list, 'w') as f:
+            for archive_id in archive_ids:
+                print('Japanese', 'http://example.com', archive_id, sep='\t', file=f)
+        return librivox_data.download_audiobooks(argparse.Namespace(
+            file_list=file_list,
+            output_directory=self.path('out'),
+            base_url=self.base_url,
+            connections=4,
+            per_host_connections=2))
+
+    def serve_book(self, archive_id, parts):
+        playlist = ''.join(
+            self.serve(f'/files/{archive_id}/{i}.mp3', data) + '\n'
+            for i, data in enumerate(parts))
+        self.serve(f'/{archive_id}/{archive_id}_64kb.m3u', playlist.encode())
+
+    def test_download_audiobooks(self):
+        parts = [os.urandom(20000) for _ in range(3)]
+        self.serve_book('book', parts)
+
+        def concatenate_parts(part_files, output_file):
+            self.write(output_file, b''.join(map(self.read, part_files)))
+
+        with unittest.mock.patch.object(librivox_data, 'concatenate_parts', concatenate_parts), \
+                contextlib.redirect_stderr(io.StringIO()):
+            self.assertEqual(self.download_audiobooks(['book', 'missing']), 1)
+        self.assertEqual(self.read(self.path('out/book.mp3')), b''.join(parts))
+        self.assertFalse(os.path.exists(self.path('out/.parts/book')))
+
+    def test_skip_complete_book(self):
+        self.serve_book('book', [os.urandom(1000)])
+        os.makedirs(self.path('out'))
+        self.write(self.path('out/book.mp3'), b'done')
+        self.assertEqual(self.download_audiobooks(['book']), 0)
+        self.assertEqual(self.read(self.path('out/book.mp3')), b'done')
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
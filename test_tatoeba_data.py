@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+#   Alphabet Soup gives language learners easily digestible chunks for practice.
+#   Copyright 2019-2020 Yorwba
+
+#   Alphabet Soup is free software: you can redistribute it and/or
+#   modify it under the terms of the GNU Affero General Public License
+#   as published by the Free Software Foundation, either version 3 of
+#   the License, or (at your option) any later version.
+
+#   Alphabet Soup is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU Affero General Public License for more details.
+
+#   You should have received a copy of the GNU Affero General Public License
+#   along with Alphabet Soup.  If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import random
+import tempfile
+import unittest
+
+import tatoeba_data
+
+
+def reference_read_escaped_lines(filename):
+    """
+    The original implementation, which the faster one has to agree with.
+    """
+    with open(filename, newline='\n') as file:
+        continued_line = ''
+        for line in file:
+            if line.endswith('\\\n'):
+                backslash_count = len(line) - len(line.rstrip('\n').rstrip('\\')) - 1
+                if backslash_count % 2:
+                    continued_line += line[:-2]+'\n'
+                    continue
+            continued_line += line[:-1]
+            yield continued_line
+            continued_line = ''
+        if continued_line:
+            yield continued_line
+
+
+def reference_split_tsv_line(line):
+    """
+    The original character-by-character implementation, which the faster one
+    has to agree with.
+    """
+    splits = []
+    current_split = ''
+    escaped = False
+    for char in line:
+        if escaped:
+            if char not in {'\\', '\t'}:
+                current_split += '\\'
+            current_split += char
+            escaped = False
+        elif char == '\\':
+            escaped = True
+        elif char == '\t':
+            if current_split == '\\N':
+                current_split = None
+            splits.append(current_split)
+            current_split = ''
+        else:
+            current_split += char
+    if current_split == '\\N':
+        current_split = None
+    splits.append(current_split)
+    return splits
+
+
+class SplitTsvLineTest(unittest.TestCase):
+
+    def assert_same_split(self, line):
+        self.assertEqual(
+            tatoeba_data.split_tsv_line(line),
+            reference_split_tsv_line(line),
+            repr(line))
+
+    def test_plain(self):
+        for line in ['', 'a', 'a\tb', '1\tjpn\t猫です。', 'N\tNN']:
+            self.assert_same_split(line)
+
+    def test_escaped_tab_and_backslash(self):
+        for line in ['a\\\tb\tc', '\\\t', 'a\\\\\tb', '\\\\\\\t', 'a\\\\b', '\\\\\\\\']:
+            self.assert_same_split(line)
+
+    def test_other_escapes(self):
+        for line in ['a\\b', '\\n\t\\x', 'C:\\Users\\\t1', '\\猫']:
+            self.assert_same_split(line)
+
+    def test_trailing_backslash(self):
+        for line in ['\\', 'a\\', 'a\t\\', 'a\\\\\\', '\\N\\']:
+            self.assert_same_split(line)
+
+    def test_null(self):
+        for line in ['\\N', '1\t\\N\t2', '\\N\t\\N', '\\\\N', '\\\\\\N', '\\N\\N', 'a\\N']:
+            self.assert_same_split(line)
+
+    def test_empty_fields(self):
+        for line in ['\t', '\t\t', 'a\t\tb', '\ta\t', '\\\t\t']:
+            self.assert_same_split(line)
+
+    def test_continuation_lines(self):
+        text = (
+            '1\tjpn\tfirst\\\nsecond\n'
+            '2\tjpn\t\\\\\n'
+            '3\tjpn\tescaped\\\\\\\nnewline\\\t\\N\n'
+            '\\N\t\\\n\t\n'
+            '4\teng\tlast\\\n')
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'sentences.csv')
+            with open(filename, 'w', newline='\n') as file:
+                file.write(text)
+            self.assertEqual(
+                list(map(tatoeba_data.split_tsv_line,
+                         tatoeba_data.read_escaped_lines(filename))),
+                list(map(reference_split_tsv_line,
+                         reference_read_escaped_lines(filename))))
+
+    def test_random(self):
+        rng = random.Random(0)
+        alphabet = ['a', 'N', '猫', ' ', '\\', '\\', '\\', '\t', '\t', '\n']
+        lines = [
+            ''.join(rng.choices(alphabet, k=rng.randrange(20)))
+            for _ in range(20000)]
+        for line in lines:
+            self.assert_same_split(line)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'sentences.csv')
+            with open(filename, 'w', newline='\n') as file:
+                for line in lines:
+                    file.write(line + '\n')
+            self.assertEqual(
+                list(map(tatoeba_data.split_tsv_line,
+                         tatoeba_data.read_escaped_lines(filename))),
+                list(map(reference_split_tsv_line,
+                         reference_read_escaped_lines(filename))))
+
+
+if __name__ == '__main__':
+    unittest.main()